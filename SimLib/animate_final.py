@@ -7,6 +7,7 @@ from SimLib.Vector import Vector
 from SimLib import model_final
 from SimLib import phobject
 from SimLib import final_controls
+from SimLib import solver
 
 class Animate():
     """
@@ -988,7 +989,7 @@ class Animate():
             self.render.add_sprites(level=self.lvl, jp_en=self.jetpack_en)
             # Set up model
             gphobjects = phobject.GravPhobjects(level.pos, level.vel, level.m)
-            self.model = model_final.NModel(gphobjects)
+            self.model = model_final.NModel(gphobjects, method=solver.Leapfrog)
     
     def _mouse_handler(self):
         """
@@ -1069,7 +1070,7 @@ class Animate():
             self.render.add_sprites(level=self.lvl, jp_en=self.jetpack_en)
             # Set up model
             gphobjects = phobject.GravPhobjects(level.pos, level.vel, level.m)
-            self.model = model_final.NModel(gphobjects)
+            self.model = model_final.NModel(gphobjects, method=solver.Leapfrog)
 
         # Close menu
         self.menu = False
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Picks a solver and time step for a model from an error budget.
+
+Short calibration runs are made with each candidate solver at several time
+steps, on copies of the model, and compared against a tight reference run.
+The cheapest configuration (fewest force evaluations) whose error is within
+the budget can then be installed in the model.  Results are cached per model
+signature, i.e. the model and physics classes, masses and initial state.
+"""
+
+import copy
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+from SimLib import solver
+
+
+class Autotuner(object):
+    """
+    Calibrates solvers and time steps against an error budget.
+
+    Works with the models of model.py and model_final.py: NModel (and
+    SlingShot), OrbitModel (and SolarSystem) and TrajectoryModel.  Solvers
+    whose callback the model's physics does not provide are skipped.
+
+    ...
+
+    Attributes
+    ----------
+    target : float
+        The error budget.
+    metric : str
+        'position' for the largest position error at the end of the run,
+        'energy' for the largest relative energy error along the run.
+    candidates : list of (type, dict)
+        Solver classes and the options to build them with.  Adaptive
+        solvers are run once per entry, starting with the model's dt_max.
+    steps : list of floats
+        Time steps to try with the fixed step solvers, as multiples of the
+        model's dt_max.
+    samples : int
+        Number of calls to advance() over a run with an adaptive solver,
+        which is when the energy is checked.
+    cache : dict
+        Results by model signature.
+    cache_file : str or None
+        JSON file the cache is loaded from and saved to.
+
+    Methods
+    -------
+    calibrate():
+        Measure every candidate.
+    tune():
+        The cheapest candidate within the budget, optionally installed.
+    install():
+        Put a configuration into a model.
+    """
+    candidates = [(solver.Euler, {}), (solver.RK2, {}), (solver.RK4, {}),
+                  (solver.Leapfrog, {}), (solver.ForestRuth, {}), (solver.Yoshida4, {}),
+                  (solver.Yoshida6, {}), (solver.RKN4, {}), (solver.RKN5, {}),
+                  (solver.AdamsBashforthMoulton, {}), (solver.Hermite, {}), (solver.WisdomHolman, {}),
+                  (solver.RK45, {'rtol': 1e-6, 'atol': 1e-6}),
+                  (solver.RK45, {'rtol': 1e-9, 'atol': 1e-9}),
+                  (solver.BulirschStoer, {}), (solver.IAS15, {})]
+    steps = [10, 3, 1, 0.3, 0.1, 0.03, 0.01]
+    samples = 64
+
+    # Position of the force among what each split callback returns
+    split_forces = {'kepler_split': 2, 'energy_split': 1, 'pair_split': 1}
+
+    def __init__(self,target,metric='position',candidates=None,steps=None,cache_file=None):
+        '''
+        Parameters
+        ----------
+        See the class attributes.  candidates and steps default to the class
+        lists.
+        '''
+        if metric not in ('position', 'energy'):
+            raise ValueError(f"metric must be 'position' or 'energy', not {metric!r}")
+        self.target = target
+        self.metric = metric
+        if candidates is not None:
+            self.candidates = candidates
+        if steps is not None:
+            self.steps = steps
+        self.cache_file = cache_file
+        self.cache = {}
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file) as file:
+                self.cache = json.load(file)
+
+    @staticmethod
+    def _physics(model):
+        '''The Physics object of a model.'''
+        for name in ('nbody', 'gravity'):
+            if hasattr(model, name):
+                return getattr(model, name)
+        raise TypeError(f"{type(model).__name__} has no physics to tune")
+
+    @staticmethod
+    def _bodies(model):
+        '''Positions and velocities of the bodies of a model, one row each.'''
+        if hasattr(model, 'gphobjects'):
+            state = model.gphobjects.state
+            return state[...,:3], state[...,3:]
+        if hasattr(model, 'orbitals'):
+            bodies = model.orbitals
+        else:
+            bodies = [model.projectile]
+        pos = np.array([[b.pos.x, b.pos.y, b.pos.z] for b in bodies])
+        vel = np.array([[b.vel.x, b.vel.y, b.vel.z] for b in bodies])
+        return pos, vel
+
+    def _energy(self,model):
+        '''Energy of the system, or of each body moving in a fixed field.'''
+        physics = self._physics(model)
+        pos, vel = self._bodies(model)
+        if hasattr(model, 'gphobjects'):
+            m = model.gphobjects.m
+            kinetic = 0.5 * np.sum(m * np.sum(vel**2, axis=-1), axis=-1)
+            dr = pos[...,:,None,:] - pos[...,None,:,:]
+            r = np.sqrt(np.sum(dr**2, axis=-1))
+            i, j = np.triu_indices(len(m), 1)
+            potential = -physics.G * np.sum(m[i] * m[j] / r[...,i,j], axis=-1)
+            return np.atleast_1d(kinetic + potential)
+        # Energy per unit mass of each body
+        kinetic = 0.5 * np.sum(vel**2, axis=-1)
+        if hasattr(physics, 'G'):
+            potential = -physics.G * physics.mass / np.sqrt(np.sum(pos**2, axis=-1))
+        else:
+            potential = -np.sum(physics.accel(0, pos, None) * pos, axis=-1)
+        return kinetic + potential
+
+    def signature(self,model,horizon):
+        '''Key of a model, and of the calibration asked for, in the cache.'''
+        pos, vel = self._bodies(model)
+        physics = self._physics(model)
+        digest = hashlib.sha1()
+        for part in (type(model).__name__, type(physics).__name__, self.metric,
+                     repr(self.target), repr(float(horizon)), repr(pos.shape),
+                     repr(float(model.dt_max)), repr(self.steps),
+                     repr([(method.__name__, options) for method, options in self.candidates])):
+            digest.update(part.encode())
+        digest.update(np.ascontiguousarray(pos, dtype=float).tobytes())
+        digest.update(np.ascontiguousarray(vel, dtype=float).tobytes())
+        if hasattr(model, 'gphobjects'):
+            digest.update(np.ascontiguousarray(model.gphobjects.m, dtype=float).tobytes())
+        return digest.hexdigest()
+
+    def install(self,model,method,dt,options=None):
+        '''
+        Give a model a new solver and time step.
+
+        Parameters
+        ----------
+        model : object
+            An NModel, OrbitModel or TrajectoryModel.
+        method : type
+            A class derived from Solver.
+        dt : float
+            The model's new dt_max.
+        options : optional dict
+            Keyword arguments for the solver's constructor.
+        '''
+        physics = self._physics(model)
+        events = getattr(physics.solver, 'events', [])
+        physics.solver = method(getattr(physics, method.callback), **(options or {}))
+        physics.solver.events = events
+        model.dt_max = dt
+
+    def _run(self,model,horizon,dt,count,limit):
+        '''
+        Advance model to horizon in calls of dt, returning the largest energy
+        error, or None once more than limit force evaluations were made.
+        '''
+        E0 = self._energy(model) if self.metric == 'energy' else None
+        worst = 0
+        while horizon - model.time > 1e-12 * max(1, abs(horizon)):
+            model.advance(min(dt, horizon - model.time))
+            if E0 is not None:
+                error = np.abs(self._energy(model) - E0) / np.maximum(np.abs(E0), 1e-300)
+                worst = max(worst, float(np.max(error)))
+            if count[0] > limit:
+                return None
+        return worst
+
+    def _trial(self,model,method,options,dt,horizon,limit=np.inf):
+        '''Run a copy of the model with one configuration.'''
+        trial = copy.deepcopy(model)
+        self.install(trial, method, dt, options)
+        physics = self._physics(trial)
+
+        # Count the force evaluations: the calls of diff_eq, accel or
+        # accel_jerk, or of the force a split hands out (WisdomHolman kicks
+        # with it twice per step), and four per step of a fused RK4 kernel
+        count = [0]
+        callback = physics.solver.diff_eq
+        def counting(function):
+            def counted(*args, **kwargs):
+                count[0] += 1
+                return function(*args, **kwargs)
+            return counted
+
+        force = self.split_forces.get(method.callback)
+        if force is None:
+            counted = counting(callback)
+        else:
+            def counted(*args, **kwargs):
+                split = list(callback(*args, **kwargs))
+                split[force] = counting(split[force])
+                return tuple(split)
+        physics.solver.diff_eq = counted
+        for name in ('accel', 'accel_jerk') + tuple(self.split_forces):
+            if getattr(physics.solver, name, None) is callback:
+                setattr(physics.solver, name, counted)
+
+        fused = getattr(physics, 'rk4_step', None)
+        if fused is not None and getattr(callback, '__self__', None) is physics:
+            def counted_fused(*args, **kwargs):
+                fnext = fused(*args, **kwargs)
+                if fnext is not None:
+                    count[0] += 4
+                return fnext
+            counted.__self__ = physics      # so that RK4 still finds the kernel
+            physics.rk4_step = counted_fused
+
+        # Adaptive solvers choose their own steps within each call to advance
+        chunk = dt
+        if method.adaptive:
+            chunk = max(dt, (horizon - model.time) / self.samples)
+
+        start = time.perf_counter()
+        with np.errstate(all='ignore'):
+            energy_error = self._run(trial, horizon, chunk, count, limit)
+        seconds = time.perf_counter() - start
+        return trial, energy_error, count[0], seconds
+
+    def calibrate(self,model,horizon):
+        '''
+        Measure the error and cost of every candidate configuration.
+
+        Parameters
+        ----------
+        model : object
+            The model, which is not modified.
+        horizon : float
+            Length of the calibration runs, in model time.
+
+        Returns
+        -------
+        results : list of dict
+            One per configuration, cheapest first, with the keys method,
+            options, dt, error, evaluations, seconds and ok (within budget).
+            A fixed step solver is not tried at steps below the first one
+            within the budget, and runs are abandoned (and left out) once
+            they cost more than the cheapest configuration found so far.
+        '''
+        key = self.signature(model, horizon)
+        if key in self.cache:
+            return self.cache[key]
+
+        physics = self._physics(model)
+        dts = [model.dt_max * s for s in self.steps]
+        horizon = model.time + horizon
+        reference = None
+        if self.metric == 'position':
+            method = solver.IAS15 if hasattr(physics, 'accel') else solver.RK45
+            options = {} if method is solver.IAS15 else {'rtol': 1e-12, 'atol': 1e-12}
+            reference, _, _, _ = self._trial(model, method, options, min(dts), horizon)
+            reference = self._bodies(reference)[0]
+
+        results = []
+        limit = np.inf      # cost of the cheapest configuration within the budget
+        for method, options in self.candidates:
+            if not hasattr(physics, method.callback):
+                continue
+            for dt in ([model.dt_max] if method.adaptive else sorted(dts, reverse=True)):
+                try:
+                    trial, energy_error, evaluations, seconds = self._trial(model, method, options, dt, horizon, limit)
+                except FloatingPointError:
+                    continue        # the solver gave up, e.g. RK45 at a close encounter
+                if evaluations > limit:
+                    break           # smaller steps would cost even more
+                if reference is None:
+                    error = energy_error
+                else:
+                    error = float(np.max(np.abs(self._bodies(trial)[0] - reference)))
+                if not np.isfinite(error):
+                    error = np.inf      # diverged, e.g. WisdomHolman on an unbound orbit
+                ok = bool(error <= self.target)
+                results.append({'method': method.__name__, 'options': dict(options), 'dt': dt,
+                                'error': error, 'evaluations': evaluations, 'seconds': seconds,
+                                'ok': ok})
+                if ok:
+                    limit = min(limit, evaluations)
+                    break
+
+        results.sort(key=lambda r: (r['evaluations'], r['error']))
+        self.cache[key] = results
+        if self.cache_file is not None:
+            with open(self.cache_file, 'w') as file:
+                json.dump(self.cache, file, indent=1)
+        return results
+
+    def tune(self,model,horizon,install=False):
+        '''
+        Find the cheapest configuration within the error budget.
+
+        Parameters
+        ----------
+        model : object
+            The model to tune.
+        horizon : float
+            Length of the calibration runs, in model time.  Errors grow with
+            it, so it should be about as long as the model will be run.
+        install : optional bool
+            Install the configuration found in the model.
+            default = False
+
+        Returns
+        -------
+        best : dict or None
+            See calibrate(), None if no configuration meets the budget.
+        '''
+        best = next((r for r in self.calibrate(model, horizon) if r['ok']), None)
+        if install and best is not None:
+            self.install(model, getattr(solver, best['method']), best['dt'], best['options'])
+        return best
+
+    @staticmethod
+    def report(results):
+        '''Table of calibration results, one line per configuration.'''
+        lines = [f"{'method':14s} {'options':28s} {'dt':>8s} {'error':>10s} {'evals':>8s} {'ok':>3s}"]
+        for r in results:
+            options = ', '.join(f"{k}={v:g}" for k, v in r['options'].items())
+            lines.append(f"{r['method']:14s} {options:28s} {r['dt']:8g} {r['error']:10.2e} "
+                         f"{r['evaluations']:8d} {'yes' if r['ok'] else 'no':>3s}")
+        return '\n'.join(lines)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the N-body diff_eq kernels.
+
+Times NBody.diff_eq of physics.py and physics_final.py (dense, and with the
+tiled, Barnes-Hut, FMM and particle-mesh engines of gravity.py) on a
+random cluster of N bodies and measures the peak memory a call allocates
+(tracemalloc, which sees NumPy's allocations), the reusable buffers of
+physics_final included.  Each kernel is called for about half a second
+per N (at least once), whatever a call costs.
+A (3, N, N) array of floats takes 24*N**2 bytes, 600 MB for N = 5000.
+
+Run from the repository root:
+
+    python -m SimLib.bench_nbody [N ...]
+"""
+
+import sys
+import os
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+import time
+import tracemalloc
+import numpy as np
+from SimLib import physics
+from SimLib import physics_final
+from SimLib import gravity
+from SimLib import phobject
+from SimLib import solver
+
+def cluster(n, seed=0):
+    '''Random bodies, positions within about 10 units of the origin.'''
+    rng = np.random.default_rng(seed)
+    pos = rng.normal(scale=10, size=(n,3))
+    vel = rng.normal(size=(n,3))
+    m = rng.uniform(0.1, 1, size=n)
+    return phobject.GravPhobjects(pos, vel, m)
+
+def measure(nbody, body, budget):
+    '''
+    Peak memory of the first call, in bytes, and mean time of a call, in
+    seconds, over as many calls as fit in budget seconds (at least one).
+    '''
+    tracemalloc.start()
+    nbody.diff_eq(0, body.state, body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    calls = 0
+    start = time.perf_counter()
+    while calls == 0 or time.perf_counter() - start < budget:
+        nbody.diff_eq(0, body.state, body)
+        calls += 1
+    return peak, (time.perf_counter() - start) / calls
+
+def main(sizes, budget=0.5):
+    print(f"{'N':>6s} {'module':>16s} {'time/call':>12s} {'peak memory':>12s} {'/ (3,N,N)':>10s}")
+    for n in sizes:
+        body = cluster(n)
+        cube = 24 * n**2
+        tree = gravity.BarnesHut(backend='numba')      # numpy without numba
+        engines = (('physics', physics.NBody(solver.RK4, body)),
+                   ('physics_final', physics_final.NBody(solver.RK4, body)),
+                   ('tiled', physics_final.NBody(solver.RK4, body, engine=gravity.Tiled())),
+                   (f'barnes-hut/{tree.backend}', physics_final.NBody(solver.RK4, body, engine=tree)),
+                   ('fmm', physics_final.NBody(solver.RK4, body, engine=gravity.FMM())),
+                   ('particle-mesh', physics_final.NBody(solver.RK4, body, engine=gravity.ParticleMesh())))
+        for name, nbody in engines:
+            peak, seconds = measure(nbody, body, budget)
+            print(f"{n:6d} {name:>16s} {seconds*1e3:9.3f} ms {peak/2**20:9.1f} MB {peak/cube:10.2f}")
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10, 100, 1000, 5000])
@@ -0,0 +1,771 @@
+# -*- coding: utf-8 -*-
+"""
+Force engines for NBody.
+
+An engine sums the pairwise gravitational accelerations of the bodies in
+place of the dense kernel of physics_final.NBody, which needs memory for a
+(3, N, N) array of differences.  It is passed to NBody(engine=...) and is
+then used wherever NBody computes the accelerations.
+"""
+
+import numpy as np
+from SimLib import jit
+
+
+class Engine(object):
+    """Base class for force engines.
+
+    Engines implement _accel for a single system, which accel calls for
+    each system of a batch, or override accel to handle the batch axes
+    themselves (Tiled).
+
+    Methods
+    -------
+    accel():
+        The accelerations of the bodies.
+    """
+
+    def accel(self,pos,m,G,out=None):
+        """The gravitational acceleration of each body due to the others
+
+        Parameters
+        ----------
+        pos : NDArray
+            Positions, one row per body, with any leading batch axes.
+        m : NDArray
+            Masses, one per body.
+        G : float
+            Gravitational constant.
+        out : optional NDArray
+            Array to write the result into, same shape as pos.
+
+        Returns
+        -------
+        accel : NDArray
+            Acceleration of each body, same shape as pos.
+        """
+        if out is None:
+            out = np.empty(pos.shape)
+        m = np.broadcast_to(np.asarray(m, dtype=float), pos.shape[:-1])
+        for index in np.ndindex(pos.shape[:-2]):
+            out[index] = self._accel(pos[index], m[index], G)
+        return out
+
+    def _accel(self,pos,m,G):
+        """Accelerations of a single system, positions pos (n, 3)
+
+        This _accel implementation in the Engine base class is a stub.
+        It exists only to define the interface for the _accel method.
+        """
+        print("Engine._accel is a stub!  This line should never be executed")
+        return          # Do nothing, simply return.
+
+
+class Tiled(Engine):
+    """
+    Direct summation over tiles of bodies.
+
+    The bodies are cut into tiles of at most tile bodies and the
+    interactions are computed one pair of tiles at a time, so the work
+    arrays are (3, tile, tile) whatever the number of bodies, and small
+    enough to stay in cache.  Each pair of tiles is visited once, its
+    differences serving both tiles.  Results agree with the dense kernel to
+    round-off.
+
+    ...
+
+    Attributes
+    ----------
+    tile : int
+        Number of bodies per tile.
+    """
+
+    def __init__(self,tile=128):
+        self.tile = tile
+        self._workspace = None
+
+    def _buffers(self,batch,tile):
+        '''Work arrays for one pair of tiles, reused from call to call.'''
+        if (self._workspace is None) or (self._workspace[0].shape != batch + (3,tile,tile)):
+            diff = np.empty(batch + (3,tile,tile))
+            d2 = np.empty(batch + (tile,tile))
+            self._workspace = (diff, d2)
+        return self._workspace
+
+    def accel(self,pos,m,G,out=None):
+        """
+        See class Engine for full docstring.
+        """
+        batch = pos.shape[:-2]
+        n = pos.shape[-2]
+        tile = min(self.tile, n)
+        diff_buffer, d2_buffer = self._buffers(batch, tile)
+        if out is None:
+            out = np.empty(pos.shape)
+
+        m = np.asarray(m, dtype=float)
+        pos = np.swapaxes(pos, -1, -2)      # (..., 3, n) view
+        a_sum = np.zeros(batch + (3,n))
+        for i0 in range(0, n, tile):
+            i1 = min(i0 + tile, n)
+            for j0 in range(i0, n, tile):
+                j1 = min(j0 + tile, n)
+                diff = diff_buffer[...,:i1-i0,:j1-j0]
+                d2 = d2_buffer[...,:i1-i0,:j1-j0]
+
+                np.subtract(pos[...,:,i0:i1,None], pos[...,:,None,j0:j1], out=diff)
+                np.einsum('...kij,...kij->...ij', diff, diff, out=d2)
+                if i0 == j0:
+                    diagonal = np.arange(i1 - i0)
+                    d2[...,diagonal,diagonal] = 1       # no self interaction (diff is zero there)
+                np.power(d2, -3/2, out=d2)
+                d2 *= G
+                np.multiply(diff, d2[...,None,:,:], out=diff)
+
+                # Each tile is pulled towards the other by the other's masses
+                a_sum[...,:,i0:i1] -= np.matmul(diff, m[...,None,j0:j1,None])[...,0]
+                if j0 != i0:
+                    a_sum[...,:,j0:j1] += np.matmul(m[...,None,None,i0:i1], diff)[...,0,:]
+
+        out[...] = np.swapaxes(a_sum, -1, -2)
+        return out
+
+
+def _ranges(start,count):
+    '''
+    The concatenation of range(start[i], start[i] + count[i]) over i, and
+    for each of its entries the i it came from.
+    '''
+    rows = np.repeat(np.arange(len(start)), count)
+    offsets = np.arange(len(rows)) - np.repeat(np.cumsum(count) - count, count)
+    return np.repeat(start, count) + offsets, rows
+
+
+def _bounds(pos):
+    '''
+    The axes along which the bodies are spread out, all three or the two
+    widest when one coordinate is the same for all of them, and the corner
+    and size of a cube around them on those axes.
+    '''
+    extent = np.ptp(pos, axis=0)
+    dim = 3 if np.all(extent > 0) else 2
+    axes = np.sort(np.argsort(-extent, kind='stable')[:dim])
+    size = np.max(extent) if np.max(extent) > 0 else 1.0
+    return axes, np.min(pos[:,axes], axis=0), size
+
+
+def _morton(q):
+    '''Morton keys of the integer coordinates q, one row per point.'''
+    dim = q.shape[1]
+    keys = np.zeros(len(q), dtype=np.uint64)
+    for k in range(dim):
+        keys |= _spread(q[:,k], dim) << np.uint64(dim - 1 - k)
+    return keys
+
+
+def _add(a,index,diff,Gm):
+    '''a[index] += Gm*diff/|diff|**3, summed over repeated indices.'''
+    d2 = np.einsum('ij,ij->i', diff, diff)
+    w = Gm / (d2 * np.sqrt(d2))
+    for k in range(a.shape[1]):
+        a[:,k] += np.bincount(index, weights=w*diff[:,k], minlength=len(a))
+
+
+def _spread(q,dim):
+    '''Spread the bits of the integers q apart, with dim - 1 zero bits between them.'''
+    q = q.astype(np.uint64)
+    if dim == 3:
+        masks = ((32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff), (8, 0x100f00f00f00f00f),
+                 (4, 0x10c30c30c30c30c3), (2, 0x1249249249249249))
+    else:
+        masks = ((16, 0x0000ffff0000ffff), (8, 0x00ff00ff00ff00ff), (4, 0x0f0f0f0f0f0f0f0f),
+                 (2, 0x3333333333333333), (1, 0x5555555555555555))
+    for shift, mask in masks:
+        q = (q | (q << np.uint64(shift))) & np.uint64(mask)
+    return q
+
+
+class BarnesHut(Engine):
+    """
+    Barnes-Hut tree code, O(N log N).
+
+    The bodies are sorted along a Morton (Z-order) curve and grouped into the
+    cells of an octree, or of a quadtree when they lie in a plane parallel to
+    two of the axes (the game's x-z plane).  A cell is split until it holds
+    at most leaf_size bodies.  A body feels a cell of size s as its total
+    mass at its centre of mass when s < theta*d, d being the distance to that
+    centre, and the body is not inside the cell; otherwise the cell is
+    opened, down to the leaves, whose bodies are summed directly.
+
+    The NumPy tree walk is vectorized: the leaves walk the tree together,
+    the pairs of leaves and cells still to be visited being kept in arrays
+    that go down the tree one level at a time, for about chunk bodies at a
+    time to bound the memory.  A leaf takes a cell whole when s < theta*(d -
+    r), r being the radius of a sphere around the leaf's bodies, so that the
+    criterion holds for each of them.  With backend='numba' every body walks
+    the tree on its own, in compiled code (see SimLib.jit), which is the
+    backend for thousands of bodies within a frame.  theta = 0.5 gives
+    relative errors of a few 1e-3, theta = 0 the direct sum.
+
+    ...
+
+    Attributes
+    ----------
+    theta : float
+        Opening angle.
+    leaf_size : int
+        Largest number of bodies in a cell that is not split.
+    chunk : int
+        Number of bodies walked down the tree together.
+    backend : str
+        'numba' for the compiled tree walk, 'numpy' otherwise.
+    """
+
+    bits = 21       # levels of the tree below the root, at most
+
+    def __init__(self,theta=0.5,leaf_size=8,chunk=1024,backend='numpy'):
+        self.theta = theta
+        self.leaf_size = leaf_size
+        self.chunk = chunk
+        self.backend = backend if jit.available else 'numpy'
+
+
+    def _keys(self,pos):
+        '''
+        Morton keys of the bodies, the number of dimensions of the tree and
+        its size.
+        '''
+        axes, lo, size = _bounds(pos)
+        cells = 2**self.bits
+        q = ((pos[:,axes] - lo) * (cells / size)).astype(np.int64)
+        np.clip(q, 0, cells - 1, out=q)
+        return _morton(q), len(axes), size
+
+    def _tree(self,keys,dim,size,pos,m):
+        '''
+        The cells of the tree for bodies sorted by key, as a dict of arrays,
+        one entry per cell, level by level from the root.  The bodies of a
+        cell are those from start to start + count, its children those from
+        child to child + children.
+        '''
+        tree = {'key': [], 'level': [], 'start': [], 'count': [], 'child': [], 'children': []}
+        key = np.zeros(1, dtype=np.uint64)
+        start = np.zeros(1, dtype=int)
+        count = np.array([len(keys)])
+        total = 0
+        for level in range(self.bits + 1):
+            child = np.zeros(len(key), dtype=int)
+            children = np.zeros(len(key), dtype=int)
+            tree['key'].append(key)
+            tree['level'].append(np.full(len(key), level))
+            tree['start'].append(start)
+            tree['count'].append(count)
+            tree['child'].append(child)
+            tree['children'].append(children)
+            total += len(key)
+
+            split = np.flatnonzero(count > self.leaf_size)
+            if level == self.bits or len(split) == 0:
+                break
+
+            # The non-empty children of the cells split, in key order
+            body, parent = _ranges(start[split], count[split])
+            sub_key = keys[body] >> np.uint64(dim*(self.bits - level - 1))
+            first = np.flatnonzero(np.diff(sub_key, prepend=~sub_key[0]) != 0)
+            children[split] = np.bincount(parent[first], minlength=len(split))
+            child[split] = total + np.cumsum(children[split]) - children[split]
+
+            key = sub_key[first]
+            start = body[first]
+            count = np.diff(np.append(first, len(body)))
+
+        tree = {name: np.concatenate(value) for name, value in tree.items()}
+
+        # Mass and centre of mass of each cell
+        end = tree['start'] + tree['count']
+        prefix = np.concatenate((np.zeros(1), np.cumsum(m)))
+        mass = prefix[end] - prefix[tree['start']]
+        prefix = np.concatenate((np.zeros((1,3)), np.cumsum(m[:,None] * pos, axis=0)))
+        com = prefix[end] - prefix[tree['start']]
+        massive = mass > 0
+        com[massive] /= mass[massive,None]
+        com[~massive] = pos[tree['start'][~massive]]     # anywhere in the cell
+        tree['mass'] = mass
+        tree['com'] = com
+        tree['width'] = size / 2.0**tree['level']
+        tree['shift'] = (dim * (self.bits - tree['level'])).astype(np.uint64)
+        return tree
+
+    def _accel(self,pos,m,G):
+        '''Accelerations of a single system, positions pos (n, 3).'''
+        keys, dim, size = self._keys(pos)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        pos = pos[order]
+        m = m[order]
+        tree = self._tree(keys, dim, size, pos, m)
+        key, shift, start, count = tree['key'], tree['shift'], tree['start'], tree['count']
+        com, mass, width, child, children = tree['com'], tree['mass'], tree['width'], tree['child'], tree['children']
+
+        n = len(pos)
+        out = np.empty((n,3))
+        if self.backend == 'numba':
+            a = jit.tree_accel(pos, m, G, self.theta, keys, key, shift, start, count,
+                               child, children, com, mass, width, np.empty((n,3)))
+            out[order] = a
+            return out
+
+        # The leaves walk the tree, each bounded by a sphere around its bodies
+        leaves = np.flatnonzero(children == 0)
+        leaves = leaves[np.argsort(start[leaves])]
+        lo = np.minimum.reduceat(pos, start[leaves])
+        hi = np.maximum.reduceat(pos, start[leaves])
+        centre = 0.5*(lo + hi)
+        radius = 0.5*np.sqrt(np.einsum('ij,ij->i', hi - lo, hi - lo))
+
+        group = max(1, self.chunk // self.leaf_size)
+        for g0 in range(0, len(leaves), group):
+            g1 = min(g0 + group, len(leaves))
+            b0 = start[leaves[g0]]
+            b1 = start[leaves[g1-1]] + count[leaves[g1-1]]
+            a = np.zeros((b1 - b0,3))
+            target = leaves[g0:g1]
+            sphere = np.arange(g0, g1)
+            cell = np.zeros(g1 - g0, dtype=int)
+            while len(cell):
+                diff = com[cell] - centre[sphere]
+                d = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+                inside = (keys[start[target]] >> shift[cell]) == key[cell]
+                far = (width[cell] < self.theta*(d - radius[sphere])) & ~inside
+
+                # Whole cells, for every body of the leaf
+                body, rows = _ranges(start[target[far]], count[target[far]])
+                source = cell[far][rows]
+                _add(a, body - b0, com.take(source, axis=0) - pos.take(body, axis=0), G*mass[source])
+
+                # Direct sum over the bodies of the leaves too close
+                near = ~far
+                leaf = near & (children[cell] == 0)
+                body, rows = _ranges(start[target[leaf]], count[target[leaf]])
+                source = cell[leaf][rows]
+                other, rows = _ranges(start[source], count[source])
+                body = body[rows]
+                pair = other != body
+                other, body = other[pair], body[pair]
+                _add(a, body - b0, pos.take(other, axis=0) - pos.take(body, axis=0), G*m[other])
+
+                # Open the others
+                opened = near & ~leaf
+                cell, rows = _ranges(child[cell[opened]], children[cell[opened]])
+                target = target[opened][rows]
+                sphere = sphere[opened][rows]
+            out[order[b0:b1]] = a
+        return out
+
+
+def _chebyshev(u,p):
+    '''
+    The Chebyshev interpolants S(u, x_k) on the p Chebyshev nodes x_k of
+    [-1, 1], and their derivatives in u, shape u.shape + (p,).
+    '''
+    nodes = np.cos(np.pi * (2*np.arange(p) + 1) / (2*p))
+    T = [np.ones_like(u), u]            # T_j(u), and T_j'(u) = j U_{j-1}(u)
+    U = [np.ones_like(u), 2*u]
+    for j in range(2, p):
+        T.append(2*u*T[-1] - T[-2])
+        U.append(2*u*U[-1] - U[-2])
+    T = np.stack(T[:p], axis=-1)
+    dT = np.stack([np.zeros_like(u)] + [j*U[j-1] for j in range(1, p)], axis=-1)
+    weights = np.cos(np.outer(np.arange(p), np.arccos(nodes))) * (2.0/p)
+    weights[0] = 1.0/p
+    return T @ weights, dT @ weights
+
+
+def _product(factors):
+    '''Products of one factor per axis, (n, p) arrays, as an (n, p**dim) array.'''
+    out = factors[0]
+    for f in factors[1:]:
+        out = (out[:,:,None] * f[:,None,:]).reshape(len(f), -1)
+    return out
+
+
+class FMM(Engine):
+    """
+    Fast multipole method, O(N).
+
+    The black-box FMM of Fong and Darve (2009).  The potential of each box is
+    interpolated on order**3 Chebyshev nodes (order**2 when the bodies lie in
+    a plane, as for BarnesHut) and the acceleration is its gradient.  The
+    masses of the leaves are moved to their nodes (P2M) and up to the
+    parents' nodes (M2M).  The potential due to the boxes of each box's
+    interaction list is evaluated at its nodes (M2L), passed down from
+    parents to children (L2L) and interpolated at the bodies (L2P).
+    Neighbouring leaves are summed directly.  The error falls by about an
+    order of magnitude for each unit of order: rms relative errors of about
+    2e-3 for order 4, 2e-5 for order 6.  The M2L, where most of the work
+    is, is compressed by singular value decomposition, to the rank the
+    order's accuracy needs.
+
+    The tree is uniform, depth levels deep, but only the boxes holding
+    bodies are stored, so that clustered bodies only cost the deeper tree
+    they need.  Unless given, depth is the one minimizing the estimated cost
+    of the direct sums and of the M2L.  All stages are vectorized, over at
+    most chunk bodies at a time.
+
+    ...
+
+    Attributes
+    ----------
+    order : int
+        Number of interpolation nodes per axis and box.
+    depth : int or None
+        Levels of the tree below the root, None to choose it from the bodies
+        (0 and 1 sum all pairs directly).
+    chunk : int
+        Number of bodies processed together.
+    """
+
+    # Costs of the M2L per interaction and per multiply-add, relative to one
+    # pair of the direct sums
+    m2l_cost = (0.2, 0.001)
+
+    def __init__(self,order=4,depth=None,chunk=65536):
+        self.order = order
+        self.depth = depth
+        self.chunk = chunk
+        self._operators = {}
+
+
+    def _operator(self,dim):
+        '''
+        The M2M matrix of each child (its bits giving its side along each
+        axis), and the compressed M2L: the bases U and V and the matrix for
+        each offset of the interaction list, None for neighbours, for boxes
+        of half width 1 and G = 1.  Computed once per order and dim.
+        '''
+        if (self.order, dim) not in self._operators:
+            p = self.order
+            nodes = np.cos(np.pi * (2*np.arange(p) + 1) / (2*p))
+            grid = np.stack(np.meshgrid(*[nodes]*dim, indexing='ij'), axis=-1).reshape(-1, dim)
+
+            m2m = []
+            for c in range(2**dim):
+                matrix = np.ones((1,1))
+                for k in range(dim):
+                    side = (c >> (dim - 1 - k)) & 1
+                    matrix = np.kron(matrix, _chebyshev(0.5*(nodes + 2*side - 1), p)[0])
+                m2m.append(matrix)      # (child node, parent node)
+
+            offsets = np.stack(np.meshgrid(*[np.arange(-3, 4)]*dim, indexing='ij'), axis=-1).reshape(-1, dim)
+            far = np.max(np.abs(offsets), axis=1) > 1
+            kernels = []
+            for offset in offsets[far]:
+                diff = grid[:,None,:] - grid[None,:,:] - 2*offset
+                kernels.append(1 / np.sqrt(np.sum(diff**2, axis=-1)))      # (target node, source node)
+
+            # Singular vectors of all the kernels side by side (U) and stacked (V)
+            s2, U = np.linalg.eigh(sum(kernel @ kernel.T for kernel in kernels))
+            _, V = np.linalg.eigh(sum(kernel.T @ kernel for kernel in kernels))
+            rank = max(1, int(np.sum(s2 > s2[-1] * 0.01**(p + 1))))
+            U = U[:,::-1][:,:rank]
+            V = V[:,::-1][:,:rank]
+            m2l = [None] * len(offsets)
+            for i, kernel in zip(np.flatnonzero(far), kernels):
+                m2l[i] = U.T @ kernel @ V
+            self._operators[(self.order, dim)] = (m2m, U, V, m2l)
+        return self._operators[(self.order, dim)]
+
+    @staticmethod
+    def _neighbours(keys,coords,n):
+        '''
+        Index of the box at each offset in {-1, 0, 1}**dim from each box of a
+        level with n boxes per side, -1 where there is none.
+        '''
+        dim = coords.shape[1]
+        offsets = np.stack(np.meshgrid(*[np.arange(-1, 2)]*dim, indexing='ij'), axis=-1).reshape(-1, dim)
+
+        # The key bits and whether inside, along each axis, for steps -1, 0, 1
+        bits = []
+        inside = []
+        for k in range(dim):
+            target = coords[:,k,None] + np.arange(-1, 2)
+            inside.append((target >= 0) & (target < n))
+            bits.append(_spread(np.clip(target, 0, n - 1), dim) << np.uint64(dim - 1 - k))
+
+        table = np.full((len(keys), len(offsets)), -1)
+        for i, offset in enumerate(offsets + 1):
+            target = bits[0][:,offset[0]]
+            found = inside[0][:,offset[0]]
+            for k in range(1, dim):
+                target = target | bits[k][:,offset[k]]
+                found = found & inside[k][:,offset[k]]
+            index = np.minimum(np.searchsorted(keys, target), len(keys) - 1)
+            found &= keys[index] == target
+            table[found,i] = index[found]
+        return table
+
+    def _levels(self,keys,cells,depth,dim):
+        '''
+        The boxes holding bodies at each level, from the root down, as
+        (keys, coords, parent, neighbours), for bodies sorted by their leaf
+        keys.
+        '''
+        first = np.flatnonzero(np.diff(keys, prepend=~keys[:1]) != 0)
+        keys = keys[first]
+        coords = cells[first]
+        levels = []
+        for l in range(depth, -1, -1):
+            up = keys >> np.uint64(dim)
+            parent = np.cumsum(np.diff(up, prepend=up[:1]) != 0)
+            levels.insert(0, (keys, coords, parent, self._neighbours(keys, coords, 2**l)))
+            first = np.flatnonzero(np.diff(up, prepend=~up[:1]) != 0)
+            keys = up[first]
+            coords = coords[first] >> 1
+        return levels
+
+    def _cost(self,x,depth,dim):
+        '''Estimated cost of a tree depth levels deep, for positions x in the unit cube.'''
+        n = 2**depth
+        cells = np.clip((x * n).astype(np.int64), 0, n - 1)
+        keys = _morton(cells)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        first = np.flatnonzero(np.diff(keys, prepend=~keys[:1]) != 0)
+        count = np.diff(np.append(first, len(keys)))
+        neighbours = self._neighbours(keys[first], cells[order][first], n)
+        near = np.sum(count[:,None] * np.where(neighbours >= 0, count[neighbours], 0))
+
+        # Boxes at each level, and the rank of the compressed M2L
+        boxes = 0
+        for l in range(2, depth + 1):
+            boxes += len(np.unique(keys[first] >> np.uint64(dim*(depth - l))))
+        rank = self._operator(dim)[1].shape[1]
+        interactions = boxes * (6**dim - 3**dim)
+        return near + self.m2l_cost[0]*interactions + self.m2l_cost[1]*interactions*rank**2
+
+    def _accel(self,pos,m,G):
+        '''Accelerations of a single system, positions pos (n, 3).'''
+        axes, lo, size = _bounds(pos)
+        dim = len(axes)
+        m2m, U, V, m2l = self._operator(dim)
+        x = (pos[:,axes] - lo) / size
+        depth = self.depth
+        if depth is None:
+            # Depths 0 and 1 both sum all the pairs directly, and no deeper
+            # tree is cheaper when that costs less than one interaction list
+            costs = [len(x)**2] * 2
+            rank = V.shape[1]
+            if len(x)**2 > len(x) + (6**dim - 3**dim)*(self.m2l_cost[0] + self.m2l_cost[1]*rank**2):
+                while len(costs) < 64 // dim and costs[-1] < 2*min(costs):
+                    costs.append(self._cost(x, len(costs), dim))
+            depth = int(np.argmin(costs))
+        n = 2**depth
+        cells = np.clip((x * n).astype(np.int64), 0, n - 1)
+        keys = _morton(cells)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        pos = pos[order][:,axes]
+        m = m[order]
+        levels = self._levels(keys, cells[order], depth, dim)
+        start = np.flatnonzero(np.diff(keys, prepend=~keys[:1]) != 0)
+        count = np.diff(np.append(start, len(pos)))
+        box = np.repeat(np.arange(len(start)), count)      # leaf of each body
+        half = size / 2**(depth + 1)
+        centre = lo + (2*levels[-1][1] + 1) * half
+        chunks = [(b0, min(b0 + self.chunk, len(pos))) for b0 in range(0, len(pos), self.chunk)]
+        octant = [(level[0] & np.uint64(2**dim - 1)).astype(int) for level in levels]
+        side = np.array([[(c >> (dim - 1 - k)) & 1 for k in range(dim)] for c in range(2**dim)])
+        adjacent = np.stack(np.meshgrid(*[np.arange(-1, 2)]*dim, indexing='ij'), axis=-1).reshape(-1, dim)
+        a = np.zeros((len(pos), dim))
+
+        if depth >= 2:
+            # P2M
+            W = [None] * (depth + 1)
+            W[depth] = np.zeros((len(start), len(U)))
+            for b0, b1 in chunks:
+                u = (pos[b0:b1] - centre[box[b0:b1]]) / half
+                S = _product([_chebyshev(u[:,k], self.order)[0] for k in range(dim)])
+                for k in range(len(U)):
+                    W[depth][:,k] += np.bincount(box[b0:b1], weights=m[b0:b1]*S[:,k], minlength=len(start))
+
+            # M2M
+            for l in range(depth, 2, -1):
+                parent = levels[l][2]
+                W[l-1] = np.zeros((len(levels[l-1][0]), len(U)))
+                for c in range(2**dim):
+                    rows = np.flatnonzero(octant[l] == c)
+                    W[l-1][parent[rows]] += W[l][rows] @ m2m[c]
+
+            # M2L, from the children of the parent's neighbours that are not
+            # neighbours themselves, then L2L
+            potential = None
+            for l in range(2, depth + 1):
+                keys, coords, parent, _ = levels[l]
+                children = np.full((len(levels[l-1][0]), 2**dim), -1)
+                children[parent, octant[l]] = np.arange(len(keys))
+                sources = W[l] @ V
+                compressed = np.zeros((len(keys), V.shape[1]))
+                for c in range(2**dim):
+                    rows = np.flatnonzero(octant[l] == c)
+                    near = levels[l-1][3][parent[rows]]
+                    for q in range(len(adjacent)):
+                        for s in range(2**dim):
+                            offset = 2*adjacent[q] + side[s] - side[c]
+                            matrix = m2l[np.sum((offset + 3) * 7**np.arange(dim - 1, -1, -1))]
+                            if matrix is None:
+                                continue
+                            source = np.where(near[:,q] >= 0, children[near[:,q],s], -1)
+                            found = source >= 0
+                            compressed[rows[found]] += sources[source[found]] @ matrix.T
+                local = compressed @ U.T * (G * 2**(l + 1) / size)      # G over the half width
+                if potential is not None:
+                    for c in range(2**dim):
+                        rows = np.flatnonzero(octant[l] == c)
+                        local[rows] += potential[parent[rows]] @ m2m[c].T
+                potential = local
+
+            # L2P: the acceleration is the gradient of the potential
+            for b0, b1 in chunks:
+                u = (pos[b0:b1] - centre[box[b0:b1]]) / half
+                S, dS = zip(*[_chebyshev(u[:,k], self.order) for k in range(dim)])
+                local = potential[box[b0:b1]]
+                for k in range(dim):
+                    factors = list(S)
+                    factors[k] = dS[k]
+                    a[b0:b1,k] = np.einsum('ij,ij->i', _product(factors), local) / half
+
+        # Direct sum over the neighbouring leaves
+        neighbours = levels[-1][3]
+        for q in range(neighbours.shape[1]):
+            target = np.flatnonzero(neighbours[:,q] >= 0)
+            source = neighbours[target,q]
+            pairs = np.cumsum(count[target] * count[source])
+            bounds = np.searchsorted(pairs, np.arange(0, pairs[-1] if len(pairs) else 0, 16*self.chunk), side='right')
+            for t0, t1 in zip(bounds, np.append(bounds[1:], len(target))):
+                body, rows = _ranges(start[target[t0:t1]], count[target[t0:t1]])
+                other, rows = _ranges(start[source[t0:t1]][rows], count[source[t0:t1]][rows])
+                body = body[rows]
+                if q == neighbours.shape[1] // 2:       # the leaf itself
+                    pair = other != body
+                    other, body = other[pair], body[pair]
+                _add(a, body, pos.take(other, axis=0) - pos.take(body, axis=0), G*m[other])
+
+        out = np.zeros((len(pos),3))
+        out[np.ix_(order, axes)] = a
+        return out
+
+
+class ParticleMesh(Engine):
+    """
+    Particle-mesh gravity, O(N + M log M) for M mesh points.
+
+    The masses are spread over the points of a mesh with cells points per
+    side by cloud-in-cell (CIC) weights, the potential is solved for with
+    FFTs, differenced across neighbouring points into accelerations, which
+    are interpolated back to the bodies with the same weights, so that no
+    body pulls on itself.  The pull is smoothed over a cell or two: this is
+    for large, smooth distributions whose pairs need not be accurate (star
+    fields, debris clouds), not for close encounters.
+
+    With boundary='isolated' the mesh is a cube around the bodies (a square
+    when they lie in a plane, as for BarnesHut), zero-padded to twice its
+    size so that the FFT's circular convolution with the Green's function
+    -G/r is the open one (Hockney and Eastwood).  With boundary='periodic'
+    the bodies are in a periodic cube of side box from origin, their
+    positions wrapped into it, and the Poisson equation is solved in Fourier
+    space with the mean density taken out.
+
+    ...
+
+    Attributes
+    ----------
+    cells : int
+        Number of mesh points per side.
+    boundary : str
+        'isolated' or 'periodic'.
+    box : float or None
+        Side of the periodic cube.
+    origin : NDArray
+        Lowest corner of the periodic cube.
+    """
+
+    def __init__(self,cells=64,boundary='isolated',box=None,origin=(0.0, 0.0, 0.0)):
+        if boundary not in ('isolated', 'periodic'):
+            raise ValueError(f"boundary must be 'isolated' or 'periodic', not {boundary!r}")
+        if boundary == 'periodic' and box is None:
+            raise ValueError("a periodic mesh needs the side of its box")
+        self.cells = cells
+        self.boundary = boundary
+        self.box = box
+        self.origin = np.asarray(origin, dtype=float)
+        self._kernels = {}
+
+
+    def _kernel(self,dim):
+        '''
+        FFT of the potential of a unit mass on the (padded) mesh, for a mesh
+        spacing of 1 and G = 1.  Computed once per dim.
+        '''
+        if dim not in self._kernels:
+            n = self.cells
+            if self.boundary == 'periodic':
+                # Eigenvalues of the discrete Laplacian, -k**2
+                k = [2*np.sin(np.pi*np.fft.fftfreq(n))]*(dim - 1) + [2*np.sin(np.pi*np.fft.rfftfreq(n))]
+                k2 = sum(np.meshgrid(*[k_i**2 for k_i in k], indexing='ij'))
+                k2.flat[0] = np.inf         # no mean density
+                self._kernels[dim] = -4*np.pi / k2
+            else:
+                r = np.minimum(np.arange(2*n), 2*n - np.arange(2*n))
+                r = np.sqrt(sum(np.meshgrid(*[r**2]*dim, indexing='ij')))
+                r.flat[0] = 1.0             # a body's own point
+                self._kernels[dim] = np.fft.rfftn(-1 / r)
+        return self._kernels[dim]
+
+    def _accel(self,pos,m,G):
+        '''Accelerations of a single system, positions pos (n, 3).'''
+        n = self.cells
+        if self.boundary == 'periodic':
+            axes = np.arange(3)
+            h = self.box / n
+            u = np.mod(pos - self.origin, self.box) / h
+        else:
+            axes, lo, size = _bounds(pos)
+            h = size / (n - 5)
+            u = 2 + (pos[:,axes] - lo) / h      # two points of margin on each side
+        dim = len(axes)
+        shape = (n,) * dim
+
+        # CIC weights of the 2**dim points around each body
+        i = np.floor(u).astype(int)
+        f = u - i
+        corners = []
+        for corner in np.ndindex((2,) * dim):
+            w = np.prod(np.where(corner, f, 1 - f), axis=1)
+            index = np.ravel_multi_index(((i + corner) % n).T, shape)
+            corners.append((index, w))
+
+        mesh = np.zeros(n**dim)
+        for index, w in corners:
+            mesh += np.bincount(index, weights=m*w, minlength=n**dim)
+        mesh = mesh.reshape(shape)
+
+        # Potential
+        kernel = self._kernel(dim)
+        if self.boundary == 'periodic':
+            potential = np.fft.irfftn(np.fft.rfftn(mesh) * kernel, s=shape)
+        else:
+            padded = (2*n,) * dim
+            potential = np.fft.irfftn(np.fft.rfftn(mesh, s=padded) * kernel, s=padded)
+            potential = potential[(slice(0, n),) * dim]
+        potential *= G / h
+
+        # Central differences, interpolated back to the bodies
+        a = np.zeros((len(pos), dim))
+        for k in range(dim):
+            field = ((np.roll(potential, 1, axis=k) - np.roll(potential, -1, axis=k)) / (2*h)).ravel()
+            for index, w in corners:
+                a[:,k] += w * field[index]
+
+        out = np.zeros((len(pos),3))
+        out[:,axes] = a
+        return out
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Optional Numba backend for the N-body kernels.
+
+Compiled versions of the pairwise gravitational acceleration and of a whole
+RK4 step for NBody (see NBody's backend option).  For the handful of bodies
+in a level, NumPy spends most of its time on call overhead, which compiled
+loops do not have.  For many bodies the acceleration is computed in parallel
+over the bodies (prange).
+
+numba is not required: when it is not installed, available is False and
+NBody stays on its NumPy code.
+"""
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+available = numba is not None
+
+# Number of bodies from which the parallel kernel is used
+parallel_threshold = 256
+
+if available:
+
+    @numba.njit(cache=True)
+    def pairwise_accel(pos, m, G, out):
+        '''
+        Direct sum of the pairwise accelerations, each pair visited once.
+
+        Parameters
+        ----------
+        pos : NDArray
+            Positions, shape (n, 3).
+        m : NDArray
+            Masses, shape (n,).
+        G : float
+            Gravitational constant.
+        out : NDArray
+            Array receiving the accelerations, shape (n, 3).
+        '''
+        n = pos.shape[0]
+        out[:,:] = 0.0
+        for i in range(n):
+            for j in range(i + 1, n):
+                dx = pos[j,0] - pos[i,0]
+                dy = pos[j,1] - pos[i,1]
+                dz = pos[j,2] - pos[i,2]
+                r2 = (dx*dx) + (dy*dy) + (dz*dz)
+                inv_r3 = G / (r2 * np.sqrt(r2))
+                s_i = m[j] * inv_r3
+                s_j = m[i] * inv_r3
+                out[i,0] += s_i*dx
+                out[i,1] += s_i*dy
+                out[i,2] += s_i*dz
+                out[j,0] -= s_j*dx
+                out[j,1] -= s_j*dy
+                out[j,2] -= s_j*dz
+        return out
+
+    @numba.njit(cache=True, parallel=True)
+    def pairwise_accel_parallel(pos, m, G, out):
+        '''
+        Direct sum of the pairwise accelerations, in parallel over the bodies.
+
+        Every pair is visited twice so that each thread only writes its own
+        rows.  Same arguments as pairwise_accel.
+        '''
+        n = pos.shape[0]
+        for i in numba.prange(n):
+            ax = 0.0
+            ay = 0.0
+            az = 0.0
+            for j in range(n):
+                if j != i:
+                    dx = pos[j,0] - pos[i,0]
+                    dy = pos[j,1] - pos[i,1]
+                    dz = pos[j,2] - pos[i,2]
+                    r2 = (dx*dx) + (dy*dy) + (dz*dz)
+                    s = G * m[j] / (r2 * np.sqrt(r2))
+                    ax += s*dx
+                    ay += s*dy
+                    az += s*dz
+            out[i,0] = ax
+            out[i,1] = ay
+            out[i,2] = az
+        return out
+
+    @numba.njit(cache=True)
+    def _diff_eq(f, m, G, parallel, out):
+        '''Velocities and accelerations for the state f, written into out.'''
+        out[:,:3] = f[:,3:]
+        if parallel:
+            pairwise_accel_parallel(f[:,:3], m, G, out[:,3:])
+        else:
+            pairwise_accel(f[:,:3], m, G, out[:,3:])
+
+    @numba.njit(cache=True)
+    def _add_scaled(f, h, k, out):
+        '''out = f + h*k, element by element.'''
+        for i in range(f.shape[0]):
+            for c in range(f.shape[1]):
+                out[i,c] = f[i,c] + (h*k[i,c])
+
+    @numba.njit(cache=True)
+    def rk4_step(f, m, G, dt, parallel, work, out):
+        '''
+        One fourth order Runge-Kutta step of the N-body equations of motion.
+
+        Parameters
+        ----------
+        f : NDArray
+            State, shape (n, 6), positions then velocities.
+        m : NDArray
+            Masses, shape (n,).
+        G : float
+            Gravitational constant.
+        dt : float
+            Time step.
+        parallel : bool
+            Use the parallel acceleration kernel.
+        work : NDArray
+            Scratch space, shape (6, n, 6).
+        out : NDArray
+            Array receiving the new state, shape (n, 6).  May be f itself.
+        '''
+        f0 = work[0]
+        k1 = work[1]
+        k2 = work[2]
+        k3 = work[3]
+        k4 = work[4]
+        tmp = work[5]
+        f0[:,:] = f
+
+        _diff_eq(f0, m, G, parallel, k1)
+        _add_scaled(f0, 0.5*dt, k1, tmp)
+        _diff_eq(tmp, m, G, parallel, k2)
+        _add_scaled(f0, 0.5*dt, k2, tmp)
+        _diff_eq(tmp, m, G, parallel, k3)
+        _add_scaled(f0, dt, k3, tmp)
+        _diff_eq(tmp, m, G, parallel, k4)
+
+        for i in range(f0.shape[0]):
+            for c in range(6):
+                out[i,c] = f0[i,c] + (dt/6)*(k1[i,c] + (2*k2[i,c]) + (2*k3[i,c]) + k4[i,c])
+        return out
+
+    @numba.njit(cache=True, parallel=True)
+    def tree_accel(pos, m, G, theta, keys, tree_key, shift, start, count, child, children, com, mass, width, out):
+        '''
+        Barnes-Hut tree walk, in parallel over the bodies.
+
+        Each body walks the tree depth first, taking a cell whole when it
+        is not inside it and width < theta*d, d being the distance to the
+        cell's centre of mass.  The bodies must be sorted by Morton key and
+        the tree built as by gravity.BarnesHut, whose arrays are passed one
+        by one: keys per body, the others per cell.
+        '''
+        n = pos.shape[0]
+        theta2 = theta*theta
+        for i in numba.prange(n):
+            stack = np.empty(8*64, dtype=np.int64)      # up to 8 children per level, 64 levels
+            stack[0] = 0
+            top = 1
+            ax = 0.0
+            ay = 0.0
+            az = 0.0
+            while top > 0:
+                top -= 1
+                c = stack[top]
+                dx = com[c,0] - pos[i,0]
+                dy = com[c,1] - pos[i,1]
+                dz = com[c,2] - pos[i,2]
+                r2 = (dx*dx) + (dy*dy) + (dz*dz)
+                if (width[c]*width[c] < theta2*r2) and ((keys[i] >> shift[c]) != tree_key[c]):
+                    s = G * mass[c] / (r2 * np.sqrt(r2))
+                    ax += s*dx
+                    ay += s*dy
+                    az += s*dz
+                elif children[c] == 0:
+                    for j in range(start[c], start[c] + count[c]):
+                        if j != i:
+                            dx = pos[j,0] - pos[i,0]
+                            dy = pos[j,1] - pos[i,1]
+                            dz = pos[j,2] - pos[i,2]
+                            r2 = (dx*dx) + (dy*dy) + (dz*dz)
+                            s = G * m[j] / (r2 * np.sqrt(r2))
+                            ax += s*dx
+                            ay += s*dy
+                            az += s*dz
+                else:
+                    for k in range(children[c]):
+                        stack[top] = child[c] + k
+                        top += 1
+            out[i,0] = ax
+            out[i,1] = ay
+            out[i,2] = az
+        return out
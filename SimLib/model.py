@@ -11,6 +11,7 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
 from SimLib import physics
+from SimLib import physics_final
 from SimLib import phobject
 from SimLib import solver
 import math
@@ -92,7 +93,7 @@ class OrbitModel():
     
     '''
     
-    def __init__(self,M,a,e,m,names=[],dt_max=0.1):
+    def __init__(self,M,a,e,m,names=[],dt_max=0.1,method=solver.RK4):
         '''Assemble the model!
         
         Parameters
@@ -106,11 +107,16 @@ class OrbitModel():
             
         dt_max : optional float
             The maximum allowable time step.  
+
+        method : optional type
+            A class derived from Solver.  With an adaptive solver (e.g.
+            solver.IAS15) each orbital is advanced in steps of the solver's
+            own choosing until the requested time is reached.
         '''
         # Instantiate system and central attractor
         self.M = M
         self.G = 6.6743E-11
-        self.gravity = physics.CentralGravity(solver.RK4, M)
+        self.gravity = physics.CentralGravity(method, M)
         self.dt_max = dt_max
         self.time = 0
 
@@ -141,8 +147,16 @@ class OrbitModel():
             The desired time increment
         
         '''
+        solver = self.gravity.solver
         for i,orbital in enumerate(self.orbitals):
-            t_new, self.orbitals[i] = self.gravity.step(self.time,orbital,dt)
+            def step(t, h):
+                t, self.orbitals[i] = self.gravity.step(t,self.orbitals[i],h)
+                return t
+        
+            # Fixed step solvers take the whole increment in one step
+            t_new = self.time
+            for t_new in solver.march(self.time, self.time + dt, self.dt_max if solver.adaptive else dt, step):
+                pass
         
         self.time = t_new
 
@@ -168,14 +182,14 @@ class SolarSystem(OrbitModel):
     Inherits from the OrbitModel class and is responsible for simulating several orbitals.
     """
 
-    def __init__(self):
+    def __init__(self, method=solver.RK4):
         solar_mass = 1.989E+30
         a = [57909036552, 1.08159e+11, 1.496e+11, 2.27987e+11, 4.488e+11]
         e = [0.206, 0.0068, 0.0167, 0.0934, 0.9]
         planet_masses = [3.285E23,4.867E24,5.972E+24,6.41693E23,2.2E14]
         names = ['Mercury','Venus','Earth','Mars','Comet']
 
-        super().__init__(solar_mass,a,e,planet_masses,names)
+        super().__init__(solar_mass,a,e,planet_masses,names,method=method)
 
 class NModel():
     '''
@@ -189,9 +203,11 @@ class NModel():
         NBody physics simulation engine.
     time : float
         Current simulation time.
+    dt_max : float
+        The maximum allowable time step.
     '''
 
-    def __init__(self, grav_bodies):
+    def __init__(self, grav_bodies, method=solver.RK4, dt_max=0.001):
         '''
         Assembles the model
         
@@ -199,10 +215,17 @@ class NModel():
         ----------
         grav_bodies : GravPhobjects
             The physical bodies. 
+        method : optional type
+            A class derived from Solver used to integrate the model.
+            default = solver.RK4
+        dt_max : optional float
+            The maximum allowable time step.
+            default = 0.001
         '''
         self.gphobjects = grav_bodies
-        self.nbody = physics.NBody(solver.RK4,self.gphobjects)
+        self.nbody = physics_final.NBody(method,self.gphobjects)
         self.time = 0
+        self.dt_max = dt_max
 
         # Center origin position
         num = np.sum(self.gphobjects.state * self.gphobjects.m[:,np.newaxis],0)
@@ -219,21 +242,26 @@ class NModel():
         Advance the model by the requested time increment.
 
         If dt>dt_max, the model will advance in increments of dt_max until
-        the requested time is reached.
+        the requested time is reached, the last one shortened so as not to
+        overshoot it.  Adaptive solvers instead advance in steps of their
+        own choosing, landing exactly on the requested time.
         
         Parameters
         ----------
         dt : float
-            The desired time increment
+            The desired time increment, not negative
         '''
-        dt_max = 0.001
-        t_new = self.time
+        if dt < 0:
+            raise ValueError(f"cannot advance by a negative time increment, {dt}")
+        solver = self.nbody.solver
 
-        if dt < dt_max:
-            t_new, self.gphobjects = self.nbody.step(t=self.time, body=self.gphobjects, dt=dt)
-        else:
-            while t_new < self.time + dt:
-                t_new, self.gphobjects = self.nbody.step(t=t_new, body=self.gphobjects, dt=dt_max)
+        def step(t, h):
+            t, self.gphobjects = self.nbody.step(t=t, body=self.gphobjects, dt=h)
+            return t
+
+        t_new = self.time
+        for t_new in solver.march(self.time, self.time + dt, self.dt_max, step):
+            pass
         
         self.time = t_new
 
@@ -258,18 +286,26 @@ class SlingShot(NModel):
     Inherits from the NModel class and is responsible for simulating several gravitational bodies.
     """
 
-    def __init__(self):
+    def __init__(self, method=solver.RK4, dt_max=0.001):
         '''
         Assembles the model.
 
         In order, the GravPhobjects array of N-bodies created represents the Sun, Earth, Jupiter, and a satellite (following the launch method).
+
+        Parameters
+        ----------
+        method : optional type
+            A class derived from Solver, e.g. solver.Yoshida6 for long runs
+            at a large dt_max.
+        dt_max : optional float
+            The maximum allowable time step.
         '''
         # Planets - Sun, Earth, Jupiter, Satellite
         pos = np.array([[0,0,0],[1,0,0],[5,0,0]])
         vel = np.array([[0,0,0],[0,0,6.3],[0,0,3]])
         m = np.array([1,0.000003003,0.000954])
         planets = phobject.GravPhobjects(pos, vel, m)
-        super().__init__(planets)
+        super().__init__(planets, method, dt_max)
 
     def launch(self, velo_scalar=1.4):
         '''
@@ -28,20 +28,54 @@ class NModel():
         NBody physics simulation engine.
     time : float
         Current simulation time.
+    dt_max : float
+        Time step for fixed step solvers, initial step for adaptive ones.
+    hits : list of (float, Event)
+        Events crossed during the last call to advance(), with their times.
+    max_steps : int
+        Most steps an adaptive solver may take in one call to advance(),
+        which otherwise raises FloatingPointError rather than hang.
     '''
 
-    def __init__(self, grav_bodies):
+    max_steps = 10000
+
+    def __init__(self, grav_bodies, method=solver.RK4, dt_max=0.001, events=None, **options):
         '''
         Assembles the model
         
         Parameters
         ----------
         grav_bodies : GravPhobjects
-            The physical bodies. 
+            The physical bodies.  Its state may hold an ensemble of B copies
+            of the bodies, (B, N, 6), e.g. one per candidate launch velocity,
+            which are then advanced together in each call (fixed step
+            solvers only, adaptive ones would share one step size).
+        method : optional type
+            A class derived from Solver used to integrate the model.
+            default = solver.RK4
+        dt_max : optional float
+            Time step for fixed step solvers, initial step for adaptive ones.
+            With solver.BlockHermite it is the largest individual step, at
+            which all bodies are brought back in sync.
+            default = 0.001
+        events : optional list of Event
+            Events of the state (see solver.Event), e.g. the distance of the
+            ball to the flag minus the hole radius.  They are located within
+            each step, so large steps do not jump over them, and a terminal
+            event stops advance() at the time it occurs.
+            default = None
+        options : optional keyword arguments
+            Passed to NBody (backend, engine) and from there to the solver
+            (e.g. rtol and atol for RK45).
         '''
+        if np.ndim(grav_bodies.state) > 2 and method.adaptive:
+            raise ValueError(f"{method.__name__} is adaptive, an ensemble of states needs a fixed step solver")
         self.gphobjects = grav_bodies
-        self.nbody = physics_final.NBody(solver.RK4,self.gphobjects)
+        self.nbody = physics_final.NBody(method,self.gphobjects,**options)
+        self.nbody.solver.events = list(events or [])
         self.time = 0
+        self.dt_max = dt_max
+        self.hits = []
 
         ''' NORMALIZE POSITIONS
         # Center origin position
@@ -58,24 +92,105 @@ class NModel():
         Advance the model by the requested time increment.
 
         If dt>dt_max, the model will advance in increments of dt_max until
-        the requested time is reached.
+        the requested time is reached, the last one shortened so as not to
+        overshoot it.  Adaptive solvers instead advance in steps of their 
+        own choosing, landing exactly on the requested time.  The model
+        stops short of it at the first terminal event, if any.
         
         Parameters
         ----------
         dt : float
-            The desired time increment
+            The desired time increment, not negative
         '''
-        dt_max = 0.001
-        t_new = self.time
+        if dt < 0:
+            raise ValueError(f"cannot advance by a negative time increment, {dt}")
+        solver = self.nbody.solver
+
+        def step(t, h):
+            t, self.gphobjects = self.nbody.step(t=t, body=self.gphobjects, dt=h)
+            return t
 
-        if dt < dt_max:
-            t_new, self.gphobjects = self.nbody.step(t=self.time, body=self.gphobjects, dt=dt)
-        else:
-            while t_new < self.time + dt:
-                t_new, self.gphobjects = self.nbody.step(t=t_new, body=self.gphobjects, dt=dt_max)
+        self.hits = []
+        t_new = self.time
+        max_steps = self.max_steps if solver.adaptive else None
+        for t_new in solver.march(self.time, self.time + dt, self.dt_max, step, max_steps):
+            if solver.events:
+                stop = self._record_hits(solver.locate_events())
+                if stop is not None:
+                    t_new = stop
+                    self.gphobjects.state = solver.dense(stop)
+                    break
         
         self.time = t_new
 
+    def _record_hits(self, hits):
+        '''Add the hits of a step to self.hits, up to the first terminal one.
+
+        Returns the time of that terminal event, or None.
+        '''
+        for t, event in hits:
+            self.hits.append((t, event))
+            if getattr(event, 'terminal', False):
+                return t
+        return None
+
+    def state_at(self, t):
+        '''State of the bodies at a time within the last solver step.
+
+        Interpolates the last step taken by advance() (see Solver.dense), 
+        e.g. to draw or test positions at times between the model's own,
+        without evaluating any forces.
+
+        Parameters
+        ----------
+        t : float
+            The time stamp, between the start of the solver's last step and
+            the model's current time.
+
+        Returns
+        -------
+        state : NDArray
+            Positions and velocities, laid out as GravPhobjects.state.
+        '''
+        return self.nbody.solver.dense(t)
+
+    def run(self, t_end, sample_dt, out=None):
+        '''Advance the model to t_end in one call, sampling the state.
+
+        The whole interval is integrated by the solver (see 
+        Solver.integrate) and the state is written into an array every 
+        sample_dt, starting with the current one, instead of calling
+        advance() from Python once per sample.  Events are not looked for.
+
+        Parameters
+        ----------
+        t_end : float
+            The time to advance to, not before the current time
+        sample_dt : float
+            Time between samples
+        out : optional NDArray
+            Array of shape (T, N, 6) receiving the T samples, e.g. an
+            np.memmap.  Allocated if not given.
+
+        Returns
+        -------
+        times : NDArray
+            The time of each sample
+        states : NDArray
+            The sampled states, one GravPhobjects.state per row
+        '''
+        if t_end < self.time:
+            raise ValueError(f"cannot run back to t_end={t_end} from time {self.time}")
+        solver = self.nbody.solver
+        t0 = self.time
+        t_new, state, out = solver.integrate(t0, self.gphobjects.state, t_end, self.dt_max,
+                                             sample_dt, params=self.gphobjects, out=out)
+        self.gphobjects.state = state
+        self.time = t_new
+
+        times = np.minimum(t0 + (sample_dt*np.arange(len(out))), t_end)
+        return times, out
+
     def advance_to(self, t):
         '''Advance the model to the requested time.
 
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Parareal parallel-in-time integration.
+
+The interval is cut into segments.  A cheap coarse propagator sweeps over
+them serially, the accurate fine propagator integrates every segment at once
+on a pool of processes, and the two are combined into a correction,
+
+    U[k+1] = G(U[k]) + F(U_old[k]) - G(U_old[k])
+
+which is repeated until the segment boundaries stop changing.  After i
+iterations the first i segments are exactly the fine solution, so the method
+always converges in at most as many iterations as there are segments; it
+pays off when it converges in far fewer than that.
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from SimLib import solver
+
+
+def _propagate(physics,method,options,x,f,x_end,dx,params):
+    '''
+    Integrate with a new solver from x to x_end, in steps of dx.
+
+    Module level so that it can be run by the worker processes.  Adaptive
+    solvers take steps of their own choosing, starting with dx.
+    '''
+    callback = getattr(physics, getattr(method, 'callback', 'diff_eq'))
+    integrator = method(callback, **options)
+    f = np.array(f, dtype=float)
+
+    def step(x, h):
+        nonlocal f
+        x, f = integrator.step(x, f, h, params)
+        return x
+
+    for x in integrator.march(x, x_end, dx, step):
+        pass
+    return f
+
+
+class Parareal(object):
+    """
+    Parareal driver around the Solver classes.
+
+    The fine segments run in a ProcessPoolExecutor, so physics, params and
+    the solver options must be picklable (the Physics and GravPhobjects
+    classes are).  Scripts using it on Windows must guard their entry point
+    with if __name__ == '__main__'.
+
+    ...
+
+    Attributes
+    ----------
+    physics : Physics
+        The differential equation, e.g. the nbody attribute of an NModel.
+        The callback each solver needs is looked up on it.
+    fine : type
+        Solver class of the fine propagator.
+    fine_dx : float
+        Step of the fine propagator.
+    coarse : type
+        Solver class of the coarse propagator.
+    coarse_dx : float
+        Step of the coarse propagator.
+    segments : int
+        Number of segments the interval is cut into.
+    tolerance : float
+        The iteration stops when no segment boundary changes by more than
+        tolerance (relative to the size of the state, when it is above 1).
+    max_iterations : int or None
+        Upper bound on the number of iterations, segments if None.
+    max_workers : int or None
+        Size of the process pool (see ProcessPoolExecutor).
+    fine_options, coarse_options : dict
+        Keyword arguments for the solver constructors.
+    iterations : int
+        Number of iterations the last call to integrate() took.
+
+    Methods
+    -------
+    integrate():
+        Integrate over an interval.
+    """
+
+    def __init__(self,physics,fine=solver.RK4,fine_dx=0.001,coarse=solver.RK4,coarse_dx=None,
+                 segments=32,tolerance=1e-10,max_iterations=None,max_workers=None,
+                 fine_options=None,coarse_options=None):
+        '''
+        Parameters
+        ----------
+        See the class attributes.  coarse_dx defaults to 16 fine steps.
+        '''
+        self.physics = physics
+        self.fine = fine
+        self.fine_dx = fine_dx
+        self.coarse = coarse
+        self.coarse_dx = coarse_dx if coarse_dx is not None else 16*fine_dx
+        self.segments = segments
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.max_workers = max_workers
+        self.fine_options = fine_options or {}
+        self.coarse_options = coarse_options or {}
+        self.iterations = 0
+
+    def _coarse(self,x,f,x_end,params):
+        '''Coarse propagation over one segment.'''
+        return _propagate(self.physics, self.coarse, self.coarse_options, x, f, x_end, self.coarse_dx, params)
+
+    def integrate(self,x,f,x_end,params=None,executor=None):
+        '''
+        Integrate from x to x_end.
+
+        Parameters
+        ----------
+        x : float
+            The independent variable at the start
+        f : ndarray of floats
+            The dependent variables at the start
+        x_end : float
+            The independent variable at the end
+        params : optional object
+            A reference to an object containing non-state attributes for the
+            differential equation
+            default = None
+        executor : optional Executor
+            Pool to run the fine segments in, e.g. to reuse one between
+            calls.  A ProcessPoolExecutor is created for the call if None.
+            default = None
+
+        Returns
+        -------
+        xs : ndarray of floats
+            The segment boundaries, segments + 1 of them
+        states : ndarray of floats
+            The state at each boundary, the last one being the state at
+            x_end
+        '''
+        K = self.segments
+        xs = np.linspace(x, x_end, K + 1)
+        max_iterations = self.max_iterations or K
+
+        # Initial coarse sweep
+        U = np.empty((K + 1,) + np.shape(f))
+        U[0] = f
+        G_old = np.empty((K,) + np.shape(f))
+        for k in range(K):
+            G_old[k] = self._coarse(xs[k], U[k], xs[k+1], params)
+            U[k+1] = G_old[k]
+
+        own_pool = executor is None
+        if own_pool:
+            executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        try:
+            self.iterations = 0
+            converged = 0       # segments known to be exact
+            while self.iterations < max_iterations and converged < K:
+                self.iterations += 1
+
+                # Fine propagation of the segments not yet exact, in parallel
+                todo = range(converged, K)
+                F = list(executor.map(_propagate,
+                                      [self.physics]*len(todo), [self.fine]*len(todo),
+                                      [self.fine_options]*len(todo),
+                                      xs[converged:K], U[converged:K], xs[converged+1:],
+                                      [self.fine_dx]*len(todo), [params]*len(todo)))
+
+                # Serial correction sweep
+                change = 0
+                for i, k in enumerate(todo):
+                    G_new = self._coarse(xs[k], U[k], xs[k+1], params)
+                    U_new = G_new + F[i] - G_old[k]
+                    G_old[k] = G_new
+                    scale = max(1, np.max(np.abs(U_new)))
+                    change = max(change, np.max(np.abs(U_new - U[k+1])) / scale)
+                    U[k+1] = U_new
+
+                converged += 1
+                if change <= self.tolerance:
+                    break
+        finally:
+            if own_pool:
+                executor.shutdown()
+
+        return xs, U
@@ -59,7 +59,8 @@ class GravPhobjects():
     ----------
     state : nx6 ndarray of floats
         Each row is an object, the first three columns are position
-        the second three columns are velocity
+        the second three columns are velocity.  An ensemble of B copies of
+        the same bodies is a Bxnx6 array.
     '''
     
     def __init__(self,pos,vel,m):
@@ -68,16 +69,19 @@ class GravPhobjects():
         ----------
         pos : nx3 array of floats
             The cartesian components of each object's position 
+            (Bxnx3 for an ensemble)
         
         vel : nx3 array of floats
             The cartesian components of each object's velocity
+            (Bxnx3 for an ensemble)
         
         m : array of masses
-            The mass of each object
+            The mass of each object (n, or Bxn if it varies across the 
+            ensemble)
         '''
         
         # Create a state matrix with the positions and velocities
-        self.state = np.hstack((np.array(pos),np.array(vel)))
+        self.state = np.concatenate((np.array(pos),np.array(vel)), axis=-1)
         self.m = np.array(m)
     
     def get_gphob(self,index):
@@ -15,10 +15,13 @@ class Physics(object):
     Attributes
     ----------
     Solver : type
-        A class derived from Solver which will be internally instantiated.        
+        A class derived from Solver which will be internally instantiated.
+        It is handed the method named by its callback attribute (diff_eq
+        unless stated otherwise).
     """
     def __init__(self,solver):
-        self.solver = solver(self.diff_eq)
+        callback = getattr(self, getattr(solver, 'callback', 'diff_eq'))
+        self.solver = solver(callback)
 
     def step(self,t,phob,dt):
         """Advance the solution one time step
@@ -52,7 +55,7 @@ class Physics(object):
         
         return t, phob
     
-    def diff_eq(self,t,f,phob=None):
+    def diff_eq(self,t,f,phob=None,out=None):
         """The cooling differential equation
         
         This diff_eq implementation in the Physics base class is a stub.
@@ -70,6 +73,11 @@ class Physics(object):
             
         params : object
             A reference to an object containing non-state attributes
+
+        out : optional ndarray
+            If given, the slope is written into this array (same shape as the
+            state) and returned, so that solvers running in place (e.g.
+            RK4 with inplace=True) allocate nothing.
         
         Returns
         -------
@@ -79,6 +87,32 @@ class Physics(object):
         print("Physics.diff_eq is a stub!  This line should never be executed")
         return          # Do nothing, simply return.
 
+    def accel(self,t,pos,params=None):
+        """The acceleration of a second order system
+        
+        This accel implementation in the Physics base class is a stub.
+        Second order systems (state laid out as [pos | vel]) define it so that
+        solvers such as RKN or Leapfrog can skip the velocity half of diff_eq.
+
+        Parameters
+        ----------
+        t : float
+            The current time
+
+        pos : ndarray of floats
+            The position half of the state
+            
+        params : object
+            A reference to an object containing non-state attributes
+        
+        Returns
+        -------
+        accel : ndarray of floats
+            The acceleration, same shape as pos
+        """
+        print("Physics.accel is a stub!  This line should never be executed")
+        return          # Do nothing, simply return.
+
     
 class Cooling(Physics):
     """
@@ -106,7 +140,7 @@ class Cooling(Physics):
         body.temperature = temp_next
         return tnext, body
             
-    def diff_eq(self,t,T,params):
+    def diff_eq(self,t,T,params,out=None):
         '''
         Calculates the derivative of temperature using the cooling differential equation.
 
@@ -118,6 +152,8 @@ class Cooling(Physics):
             The current time    
         params : object
             A reference to an object containing non-state attributes
+        out : optional ndarray
+            Array to write the result into, same shape as T.
         
         Returns
         -------
@@ -125,6 +161,9 @@ class Cooling(Physics):
             The slope at t
         '''
         dT = params.k * (self.Ta - T)
+        if out is not None:
+            out[...] = dT
+            return out
         return dT
 
 class UniformGravity(Physics):
@@ -162,7 +201,7 @@ class UniformGravity(Physics):
         body.vel.z = fnew[5]
         return tnext, body
             
-    def diff_eq(self,t,f,params):
+    def diff_eq(self,t,f,params,out=None):
         '''
         Calculates the derivative of temperature using the uniform gravity differential equation.
 
@@ -174,23 +213,42 @@ class UniformGravity(Physics):
             Force.
         params : object
             A reference to an object containing non-state attributes.
+        out : optional NDArray
+            Array to write the result into, same shape as f.
         
         Returns
         -------
         dfdt : float
             The slope at t
         '''
-        # Acceleration
-        ax = 0
-        ay = 0
-        az = -9.7
+        if out is None:
+            out = np.empty(np.shape(f))
+
+        # Velocity, then acceleration
+        out[:3] = f[3:]
+        out[3:] = self.accel(t, f[:3], params)
 
-        # Velocity
-        vx = f[3]
-        vy = f[4]
-        vz = f[5]
+        return out
 
-        return np.array([vx, vy, vz, ax, ay, az])
+    def accel(self,t,pos,params):
+        '''
+        The (constant) acceleration due to uniform gravity.
+
+        Parameters
+        ----------
+        t : float
+            The current time.   
+        pos : NDArray
+            Position (x,y,z).
+        params : object
+            A reference to an object containing non-state attributes.
+        
+        Returns
+        -------
+        accel : NDArray
+            Acceleration components, same shape as pos.
+        '''
+        return np.zeros(np.shape(pos)) + np.array([0, 0, -9.7])
     
 class CentralGravity(Physics):
     """
@@ -228,7 +286,7 @@ class CentralGravity(Physics):
         body.vel.z = fnew[5]
         return tnext, body
             
-    def diff_eq(self,t,f,params):
+    def diff_eq(self,t,f,params,out=None):
         '''
         Calculates the derivative of temperature using the central gravity differential equation.
 
@@ -240,33 +298,102 @@ class CentralGravity(Physics):
             Position and velocity vectors, with f[0-2] being (x,y,z) coordinates and f[3-5] being velocity components.
         params : object
             A reference to an object containing non-state attributes.
+        out : optional NDArray
+            Array to write the result into, same shape as f.
         
         Returns
         -------
         dfdt : float
             The slope at t
         '''
-        Fconstant = -(self.G * self.mass) / (((f[0]**2) + (f[1]**2) + (f[2]**2))**(3/2))
-        Fx = Fconstant * f[0]
-        Fy = Fconstant * f[1]
-        Fz = Fconstant * f[2]
-
-        # Acceleration
-        ax = Fx
-        ay = Fy
-        az = Fz
-
-        # Velocity
-        vx = f[3]
-        vy = f[4]
-        vz = f[5]
-
-        return np.array([vx, vy, vz, ax, ay, az])
+        if out is None:
+            out = np.empty(np.shape(f))
+
+        # Velocity, then acceleration
+        out[:3] = f[3:]
+        out[3:] = self.accel(t, f[:3], params)
+
+        return out
+
+    def accel(self,t,pos,params):
+        '''
+        Calculates the acceleration towards the central attractor.
+
+        Parameters
+        ----------
+        t : float
+            The current time.   
+        pos : NDArray
+            Position (x,y,z), with the attractor at the origin.
+        params : object
+            A reference to an object containing non-state attributes.
+        
+        Returns
+        -------
+        accel : NDArray
+            Acceleration components, same shape as pos.
+        '''
+        Fconstant = -(self.G * self.mass) / (np.sum(pos**2, axis=-1)**(3/2))
+        return Fconstant[...,None] * pos
+
+    def kepler_split(self,params):
+        '''
+        The whole motion is a Kepler orbit about the fixed attractor, there
+        are no interactions (see solver.WisdomHolman).
+
+        Parameters
+        ----------
+        params : object
+            A reference to an object containing non-state attributes.
+
+        Returns
+        -------
+        central : None
+            The attractor is fixed at the origin rather than part of the state.
+        mu : float
+            G times the mass of the attractor.
+        interaction : function
+            interaction(t, pos) returns the (zero) perturbing acceleration.
+        '''
+        def interaction(t, pos):
+            return np.zeros(np.shape(pos))
+
+        return None, self.G*self.mass, interaction
+
+    def energy_split(self,params):
+        '''
+        Splits the energy per unit mass of the orbiting body into its kinetic
+        and potential parts (see solver.LogHLeapfrog).
+
+        Parameters
+        ----------
+        params : object
+            A reference to an object containing non-state attributes.
+
+        Returns
+        -------
+        m : float
+            1, energies being per unit mass.
+        accel : function
+            accel(t, pos) returns the acceleration towards the attractor.
+        potential : function
+            potential(pos) returns -G*M/r.
+        '''
+        def accel(t, pos):
+            return self.accel(t, pos, params)
+
+        def potential(pos):
+            return -(self.G * self.mass) / np.sqrt(np.sum(pos**2, axis=-1))
+
+        return 1.0, accel, potential
     
 class NBody(Physics):
     """
     Encodes the differential equations for an N-body physical system.
 
+    The models use physics_final.NBody.  This plain NumPy version is the
+    baseline SimLib/bench_nbody.py measures it against.
+
     Attributes
     ----------
     solver : Solver
@@ -291,7 +418,7 @@ class NBody(Physics):
 
         return tnext, body
             
-    def diff_eq(self,t,f,params):
+    def diff_eq(self,t,f,params,out=None):
         '''
         Calculates the velocities and accelerations of each N-body phobject.
 
@@ -305,37 +432,50 @@ class NBody(Physics):
             Each row represents a different Phobject.
         params : GravPhobjects
             A reference to the GravPhobjects object containing non-state attributes.
+        out : optional NDArray
+            Array to write the result into, same shape as f.
         
         Returns
         -------
         state : NDArray
             Updated velocities and accelerations of each GravPhobject.
         '''
-        pos = f[:,:3]
-        n = f.shape[0]
+        if out is None:
+            out = np.empty(f.shape)
+        out[:,:3] = f[:,3:]
+        out[:,3:] = self.accel(t, f[:,:3], params)
 
-        pos = pos[:,:,None]
-        pos = pos.transpose((1,0,2))
-        o = np.ones((3,n,n))
+        return out
 
-        cube = pos * o
-        cube2 = cube.transpose((0,2,1))
+    def accel(self,t,pos,params):
+        '''
+        Calculates the accelerations of each N-body phobject.
 
-        diff = cube - cube2     # r matrix / distances between objects
-        diff_sq = diff**2
-        d2 = np.sum(diff_sq,axis=0)
-        d2 = d2 + np.eye(n)
-        denominator = (d2**(-3/2))
+        Parameters
+        ----------
+        t : float
+            The current time.   
+        pos : NDArray
+            Positions of all GravPhobjects, one row per Phobject.
+        params : GravPhobjects
+            A reference to the GravPhobjects object containing non-state attributes.
+        
+        Returns
+        -------
+        a_sum : NDArray
+            Acceleration of each GravPhobject.
+        '''
+        n = pos.shape[0]
 
-        masses = params.m[:,np.newaxis]
-        masses = masses.transpose((1,0))
-        masses = masses * o
+        pos = pos.T
+        diff = pos[:,:,None] - pos[:,None,:]     # r matrix / distances between objects
+        d2 = np.einsum('kij,kij->ij', diff, diff)
+        d2[np.diag_indices(n)] = 1      # no self interaction (diff is zero there)
+        denominator = np.power(d2, -3/2, out=d2)
 
-        accel = -(denominator * diff * masses * self.G)
-        a_sum = np.sum(accel,axis=2)
+        denominator *= -self.G * params.m       # masses broadcast over the source axis
+        diff *= denominator
+        a_sum = np.sum(diff,axis=2)
         a_sum = a_sum.T
 
-        v = f[:,3:]
-        state = np.hstack((v,a_sum))
-
-        return state
\ No newline at end of file
+        return a_sum
\ No newline at end of file
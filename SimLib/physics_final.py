@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+from SimLib import jit
 
 """
 The Physics base class and its children
@@ -15,10 +16,15 @@ class Physics(object):
     Attributes
     ----------
     Solver : type
-        A class derived from Solver which will be internally instantiated.        
+        A class derived from Solver which will be internally instantiated.
+        It is handed the method named by its callback attribute (diff_eq
+        unless stated otherwise).
+    options : optional keyword arguments
+        Passed on to the solver's constructor (e.g. tolerances).
     """
-    def __init__(self,solver):
-        self.solver = solver(self.diff_eq)
+    def __init__(self,solver,**options):
+        callback = getattr(self, getattr(solver, 'callback', 'diff_eq'))
+        self.solver = solver(callback,**options)
 
     def step(self,t,phob,dt):
         """Advance the solution one time step
@@ -52,7 +58,7 @@ class Physics(object):
         
         return t, phob
     
-    def diff_eq(self,t,f,phob=None):
+    def diff_eq(self,t,f,phob=None,out=None):
         """The cooling differential equation
         
         This diff_eq implementation in the Physics base class is a stub.
@@ -70,6 +76,11 @@ class Physics(object):
             
         params : object
             A reference to an object containing non-state attributes
+
+        out : optional ndarray
+            If given, the slope is written into this array (same shape as the
+            state) and returned, so that solvers running in place (e.g. 
+            RK4 with inplace=True) allocate nothing.
         
         Returns
         -------
@@ -78,6 +89,32 @@ class Physics(object):
         """
         print("Physics.diff_eq is a stub!  This line should never be executed")
         return          # Do nothing, simply return.
+
+    def accel(self,t,pos,params=None):
+        """The acceleration of a second order system
+        
+        This accel implementation in the Physics base class is a stub.
+        Second order systems (state laid out as [pos | vel]) define it so that
+        solvers such as RKN or Leapfrog can skip the velocity half of diff_eq.
+
+        Parameters
+        ----------
+        t : float
+            The current time
+
+        pos : ndarray of floats
+            The position half of the state
+            
+        params : object
+            A reference to an object containing non-state attributes
+        
+        Returns
+        -------
+        accel : ndarray of floats
+            The acceleration, same shape as pos
+        """
+        print("Physics.accel is a stub!  This line should never be executed")
+        return          # Do nothing, simply return.
     
 class NBody(Physics):
     """
@@ -91,12 +128,44 @@ class NBody(Physics):
     grav_bodies : GravPhobjects
         The physical bodies.
     G : Netwon's gravitational constant in Kepler units.
+    backend : str
+        'numba' if the accelerations (and RK4 steps) are computed by the
+        compiled kernels of SimLib.jit, 'numpy' otherwise.
+    engine : Engine or None
+        Force engine summing the accelerations (see SimLib.gravity), None
+        for the dense kernel.
     """
 
-    def __init__(self,solver,grav_bodies):
-        super().__init__(solver)
+    def __init__(self,solver,grav_bodies,backend='numpy',engine=None,**options):
+        '''
+        Parameters
+        ----------
+        solver : type
+            See class Physics.
+        grav_bodies : GravPhobjects
+            The physical bodies.
+        backend : optional str
+            'numba' to use the compiled kernels.  Falls back to 'numpy' when
+            numba is not installed.
+            default = 'numpy'
+        engine : optional Engine
+            Force engine for the accelerations, e.g. gravity.Tiled() for
+            more bodies than the dense kernel has memory for,
+            gravity.BarnesHut() for thousands of them, gravity.FMM()
+            for hundreds of thousands, or gravity.ParticleMesh() for
+            smooth clouds whose pairs need not be accurate.  Takes 
+            precedence over backend.
+            default = None
+        options : optional keyword arguments
+            Passed on to the solver's constructor.
+        '''
+        super().__init__(solver,**options)
         self.gphobjects = grav_bodies
         self.G = 4*(np.pi**2)
+        self.backend = backend if jit.available else 'numpy'
+        self.engine = engine
+        self._workspace = None
+        self._jit_workspace = None
         
     def step(self,t,body,dt,params=None):
         """
@@ -107,7 +176,7 @@ class NBody(Physics):
 
         return tnext, body
             
-    def diff_eq(self,t,f,params):
+    def diff_eq(self,t,f,params,out=None):
         '''
         Calculates the velocities and accelerations of each N-body phobject.
 
@@ -118,40 +187,249 @@ class NBody(Physics):
         f : NDArray
             State array of all GravPhobjects
             The first 3 columns are position and the latter 3 are velocity.
-            Each row represents a different Phobject.
+            Each row represents a different Phobject.  Leading axes index
+            independent copies of the system, e.g. (B, N, 6) for an ensemble.
         params : GravPhobjects
             A reference to the GravPhobjects object containing non-state attributes.
+        out : optional NDArray
+            Array to write the result into, same shape as f.
         
         Returns
         -------
         state : NDArray
             Updated velocities and accelerations of each GravPhobject.
         '''
-        pos = f[:,:3]
-        n = f.shape[0]
+        if out is None:
+            out = np.empty(f.shape)
+        out[...,:3] = f[...,3:]
+        self.accel(t, f[...,:3], params, out=out[...,3:])
+
+        return out
+
+    def accel(self,t,pos,params,out=None):
+        '''
+        Calculates the accelerations of each N-body phobject.
+
+        Parameters
+        ----------
+        t : float
+            The current time.   
+        pos : NDArray
+            Positions of all GravPhobjects, one row per Phobject, with any 
+            leading batch axes.
+        params : GravPhobjects
+            A reference to the GravPhobjects object containing non-state attributes.
+        out : optional NDArray
+            Array to write the result into, same shape as pos.
+        
+        Returns
+        -------
+        a_sum : NDArray
+            Acceleration of each GravPhobject.
+        '''
+        return self._pairwise_accel(pos, params.m, out=out)
+
+    def _buffers(self,batch,n):
+        '''Scratch arrays for n bodies (times the batch shape), reused from call to call.'''
+        if (self._workspace is None) or (self._workspace[0].shape != batch + (3,n,n)):
+            diff = np.empty(batch + (3,n,n))
+            d2 = np.empty(batch + (n,n))
+            a_sum = np.empty(batch + (3,n))
+            self._workspace = (diff, d2, a_sum)
+        return self._workspace
+
+    def _pairwise_accel(self,pos,m,out=None):
+        '''Direct sum of the pairwise accelerations for positions pos (..., n, 3) and masses m.'''
+        if self.engine is not None:
+            return self.engine.accel(pos, m, self.G, out=out)
+
+        if self.backend == 'numba' and pos.ndim == 2 and np.ndim(m) == 1:
+            if out is None:
+                out = np.empty(pos.shape)
+            kernel = jit.pairwise_accel_parallel if len(pos) >= jit.parallel_threshold else jit.pairwise_accel
+            return kernel(pos, np.asarray(m, dtype=float), self.G, out)
 
-        pos = pos[:,:,None]
-        pos = pos.transpose((1,0,2))
-        o = np.ones((3,n,n))
+        batch = pos.shape[:-2]
+        n = pos.shape[-2]
+        diff, d2, a_sum = self._buffers(batch, n)
+        if out is None:
+            out = np.empty(pos.shape)
 
-        cube = pos * o
-        cube2 = cube.transpose((0,2,1))
+        pos = np.swapaxes(pos, -1, -2)      # (..., 3, n) view
+        np.subtract(pos[...,:,:,None], pos[...,:,None,:], out=diff)     # r matrix / distances between objects
+        np.einsum('...kij,...kij->...ij', diff, diff, out=d2)      # squared distances, no (3,n,n) temporary
+        d2.reshape(batch + (n*n,))[...,::n+1] = 1       # no self interaction (diff is zero there)
+        np.power(d2, -3/2, out=d2)
 
-        diff = cube - cube2     # r matrix / distances between objects
-        diff_sq = diff**2
-        d2 = np.sum(diff_sq,axis=0)
-        d2 = d2 + np.eye(n)
-        denominator = (d2**(-3/2))
+        np.multiply(d2, m[...,None,:], out=d2)      # m broadcasts over the source axis
+        d2 *= -self.G
+        np.multiply(diff, d2[...,None,:,:], out=diff)
+        np.sum(diff, axis=-1, out=a_sum)
+        out[...] = np.swapaxes(a_sum, -1, -2)
 
-        masses = params.m[:,np.newaxis]
-        masses = masses.transpose((1,0))
-        masses = masses * o
+        return out
 
-        accel = -(denominator * diff * masses * self.G)
-        a_sum = np.sum(accel,axis=2)
-        a_sum = a_sum.T
+    def rk4_step(self,t,f,dt,params,out=None):
+        '''
+        A whole RK4 step computed by the compiled kernel (see solver.RK4).
+
+        Parameters
+        ----------
+        t : float
+            The current time.   
+        f : NDArray
+            State array of all GravPhobjects.
+        dt : float
+            The time step.
+        params : GravPhobjects
+            A reference to the GravPhobjects object containing non-state attributes.
+        out : optional NDArray
+            Array to write the new state into, same shape as f.
+
+        Returns
+        -------
+        state : NDArray or None
+            The state after the step, None if the numba backend is off, an
+            engine is set or f is an ensemble, in which case the caller 
+            takes the step itself.
+        '''
+        if self.backend != 'numba' or self.engine is not None or np.ndim(f) != 2 or np.ndim(params.m) != 1:
+            return None
+        n = len(f)
+        if (self._jit_workspace is None) or (self._jit_workspace.shape[1] != n):
+            self._jit_workspace = np.empty((6, n, 6))
+        if out is None:
+            out = np.empty(f.shape)
+        return jit.rk4_step(f, np.asarray(params.m, dtype=float), self.G, dt,
+                            n >= jit.parallel_threshold, self._jit_workspace, out)
+
+    def accel_jerk(self,t,pos,vel,params,active=None):
+        '''
+        Calculates the acceleration and jerk of each N-body phobject.
+
+        Both come out of the same pass over the pairwise separations, which
+        is what the Hermite solvers need.
+
+        Parameters
+        ----------
+        t : float
+            The current time.   
+        pos : NDArray
+            Positions of all GravPhobjects, one row per Phobject.
+        vel : NDArray
+            Velocities of all GravPhobjects, one row per Phobject.
+        params : GravPhobjects
+            A reference to the GravPhobjects object containing non-state attributes.
+        active : optional array of ints
+            Indices of the bodies to evaluate, all of them by default.  Every
+            body still acts as a source.
+        
+        Returns
+        -------
+        accel : NDArray
+            Acceleration of each (active) GravPhobject.
+        jerk : NDArray
+            Time derivative of the acceleration of each (active) GravPhobject.
+        '''
+        if active is None:
+            active = np.arange(pos.shape[-2])
+        # dr[i,j] points from active body i to body j
+        dr = pos[...,None,:,:] - pos[...,active,None,:]
+        dv = vel[...,None,:,:] - vel[...,active,None,:]
+
+        r2 = np.sum(dr**2, axis=-1)
+        r2[...,np.arange(len(active)),active] = np.inf      # no self interaction
+        rv = np.sum(dr*dv, axis=-1)
+
+        gm_r3 = self.G * params.m[...,None,:] * r2**(-3/2)
+        accel = np.sum(gm_r3[...,None] * dr, axis=-2)
+        jerk = np.sum(gm_r3[...,None] * (dv - (3*(rv/r2)[...,None]*dr)), axis=-2)
+
+        return accel, jerk
+
+    def kepler_split(self,params):
+        '''
+        Splits the system into Kepler orbits about its most massive body and
+        the interactions between the other bodies (see solver.WisdomHolman).
+
+        Parameters
+        ----------
+        params : GravPhobjects
+            A reference to the GravPhobjects object containing non-state attributes.
+
+        Returns
+        -------
+        central : int
+            Row of the central (most massive) body in the state.
+        mu : float
+            G times the mass of the central body.
+        interaction : function
+            interaction(t, pos) returns the accelerations the other bodies
+            exert on each other, given their positions (one row each, in
+            state order with the central body left out).
+        '''
+        m = params.m
+        central = int(np.argmax(m))
+        m_others = np.delete(m, central)
+
+        def interaction(t, pos):
+            return self._pairwise_accel(pos, m_others)
+
+        return central, self.G*m[central], interaction
+
+    def energy_split(self,params):
+        '''
+        Splits the energy of the system into the kinetic energy of the bodies
+        and their potential energy (see solver.LogHLeapfrog).
+
+        Parameters
+        ----------
+        params : GravPhobjects
+            A reference to the GravPhobjects object containing non-state attributes.
+
+        Returns
+        -------
+        m : NDArray
+            Mass of each body.
+        accel : function
+            accel(t, pos) returns the acceleration of each body.
+        potential : function
+            potential(pos) returns the potential energy of the system, the
+            sum of -G*m_i*m_j/r_ij over the pairs of bodies.
+        '''
+        m = params.m
+        i, j = np.triu_indices(len(m), 1)
+        mm = m[i] * m[j]
+
+        def accel(t, pos):
+            return self._pairwise_accel(pos, m)
+
+        def potential(pos):
+            r = np.sqrt(np.sum((pos[...,i,:] - pos[...,j,:])**2, axis=-1))
+            return -self.G * np.sum(mm / r, axis=-1)
+
+        return m, accel, potential
+
+    def pair_split(self,params):
+        '''
+        Gravitational parameters and accelerations of the bodies, from which
+        close pairs are regularized (see solver.KustaanheimoStiefel).
+
+        Parameters
+        ----------
+        params : GravPhobjects
+            A reference to the GravPhobjects object containing non-state attributes.
+
+        Returns
+        -------
+        gm : NDArray
+            G times the mass of each body.
+        accel : function
+            accel(t, pos) returns the acceleration of each body.
+        '''
+        m = params.m
 
-        v = f[:,3:]
-        state = np.hstack((v,a_sum))
+        def accel(t, pos):
+            return self._pairwise_accel(pos, m)
 
-        return state
\ No newline at end of file
+        return self.G*m, accel
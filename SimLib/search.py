@@ -28,9 +28,13 @@ class Bisection():
     left_error : float
         The error signal at the left bracket
 
+    decimals : int
+        Function values that round to zero at this many decimals are taken
+        as the root
+
     """
 
-    def __init__(self,left_bracket,right_bracket,func):
+    def __init__(self,left_bracket,right_bracket,func,decimals=2):
         """Create a Bisection object
 
         Parameters
@@ -43,10 +47,15 @@ class Bisection():
 
         func : function
             The function to be evaluated
+
+        decimals : optional int
+            Resolution of the function value, in decimal places
+            default = 2
         """
         self.left = left_bracket
         self.right = right_bracket
         self.func = func
+        self.decimals = decimals
         self.left_error = abs(self.func(self.left))
         self.right_error = abs(self.func(self.right))
 
@@ -65,7 +74,7 @@ class Bisection():
         current best parameter estimate and current error estimate
         """
         param, midpoint = self.param()
-        if (round(param,2)) == 0:           # Set resolution with rounding decimal count
+        if (round(param,self.decimals)) == 0:           # Set resolution with rounding decimal count
             return midpoint, 0
         elif (param * self.func(self.left) < 0):
             self.right = midpoint
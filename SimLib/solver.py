@@ -5,6 +5,54 @@ This set of classes implements various differential equation solving
 algorithms.  They are intended for use with the classes derived from Physics.
 """
 
+import collections
+import math
+import numpy as np
+from SimLib import search
+
+def _land(step,h,elapsed,result,target,max_iterations=50):
+    '''
+    Adjust the size of a step so that it ends exactly on a target (secant
+    method), for solvers stepping in a variable other than x.
+
+    step(h) returns the change in x over a step of size h and the result of
+    the step.  h, elapsed and result are those of a first attempt.
+    '''
+    h_a, g_a = 0.0, -target
+    h_b, g_b = h, elapsed - target
+    for i in range(max_iterations):
+        if abs(g_b) <= 1e-14*abs(target) or g_b == g_a:
+            break
+        h_next = h_b - (g_b * (h_b - h_a) / (g_b - g_a))
+        elapsed, result = step(h_next)
+        h_a, g_a, h_b, g_b = h_b, g_b, h_next, elapsed - target
+    return result
+
+class Event(object):
+    """A zero crossing of a function of the state, located within steps.
+
+    Attributes
+    ----------
+    func : Callable
+        Event function func(x, f) of the independent and the dependent
+        variables, e.g. a distance minus a radius.  The event occurs where
+        it changes sign.
+
+    terminal : bool
+        True if integration should stop at the event.
+
+    direction : int
+        1 to only report crossings from negative to positive, -1 for the
+        reverse, 0 for both.
+    """
+    def __init__(self,func,terminal=False,direction=0):
+        self.func = func
+        self.terminal = terminal
+        self.direction = direction
+
+    def __call__(self,x,f):
+        return self.func(x, f)
+
 class Solver(object):
     """Differential equation solver base class.
     
@@ -12,11 +60,194 @@ class Solver(object):
     ----------
     diff_eq : Callable
         A reference to a diff_eq function 
+
+    adaptive : bool
+        True if the solver chooses its own step size.  Adaptive solvers may
+        take a smaller step than the one requested and publish the size they
+        would like to try next in dx_next.
+
+    callback : str
+        Name of the Physics method the solver is built around.  Most solvers
+        use 'diff_eq'; solvers for second order systems use 'accel', which 
+        returns only the acceleration for the positions in the state.
+
+    events : list of Event
+        Events to look for with locate_events() (plain functions are 
+        treated as non-terminal events).
+
+    Once a step has been taken, dense(x) gives the solution anywhere inside
+    it.
     
     """
+    adaptive = False
+    callback = 'diff_eq'
     
     def __init__(self,diff_eq):
         self.diff_eq = diff_eq
+        self._x_last = None
+        self._f_last = None
+        self._params_last = None
+        self._x_start = None
+        self._f_start = None
+        self._df = None
+        self.events = []
+
+    def _remember(self,x,f,params=None):
+        """Record the state returned by the last step.
+
+        Solvers that carry information from one step to the next (e.g. a
+        derivative that is reused) call this so that _continues() can tell
+        whether the next call picks up where the last one left off.
+        """
+        self._x_last = x
+        if (self._f_last is None) or (np.shape(self._f_last) != np.shape(f)):
+            self._f_last = np.array(f, dtype=float)
+        else:
+            np.copyto(self._f_last, f)
+        self._params_last = params
+
+    def _keep_step(self,x,f,xnext,fnext,params=None,df=None,dfnext=None):
+        """Record the step just taken, for _continues() and dense().
+
+        df and dfnext are the derivatives of the state at the start and the
+        end of the step, if the solver has them at hand.  Missing ones are
+        evaluated when dense() first needs them.
+        """
+        self._x_start = x
+        if (self._f_start is None) or (np.shape(self._f_start) != np.shape(f)):
+            self._f_start = np.array(f, dtype=float)
+        else:
+            np.copyto(self._f_start, f)
+        self._df = [df, dfnext]
+        self._remember(xnext, fnext, params)
+
+    def _derivative(self,x,f,params=None):
+        """Derivative of the state, built from the solver's callback."""
+        if self.callback == 'diff_eq':
+            return self.diff_eq(x, f, params)
+        n = np.shape(f)[-1] // 2
+        if self.callback == 'accel_jerk':
+            a = self.diff_eq(x, f[...,:n], f[...,n:], params)[0]
+        else:
+            a = self.diff_eq(x, f[...,:n], params)
+        return self._with_velocity(f, a)
+
+    @staticmethod
+    def _with_velocity(f,a):
+        """Derivative of a [pos | vel] state whose acceleration is a."""
+        if a is None:
+            return None
+        n = np.shape(f)[-1] // 2
+        return np.concatenate((f[...,n:], a), axis=-1)
+
+    def dense(self,x):
+        ''' Solution at x within the last step taken
+
+        The base class fits a cubic Hermite polynomial through the state and
+        its derivative at both ends of the step.  Solvers with a better
+        interpolant of their own override this method.  Derivatives the
+        solver did not already have are evaluated once per step, on the
+        first call.
+
+        Parameters
+        ----------
+        x : float
+            The independent variable, between the start and the end of the
+            last step.
+
+        Returns
+        -------
+        f : float or ndarray of floats
+            The interpolated dependent variables
+        '''
+        if self._f_start is None:
+            raise RuntimeError("dense() needs a step to interpolate")
+        x0 = self._x_start
+        x1 = self._x_last
+        if self._df[0] is None:
+            self._df[0] = self._derivative(x0, self._f_start, self._params_last)
+        if self._df[1] is None:
+            self._df[1] = self._derivative(x1, self._f_last, self._params_last)
+        return self._hermite(x, x0, x1, self._f_start, self._f_last, *self._df)
+
+    @staticmethod
+    def _hermite(x,x0,x1,f0,f1,df0,df1):
+        """Cubic Hermite interpolation between (x0, f0) and (x1, f1)."""
+        h = x1 - x0
+        s = (x - x0) / h
+        h00 = (1 + 2*s) * (1 - s)**2
+        h10 = s * (1 - s)**2
+        h01 = s**2 * (3 - 2*s)
+        h11 = s**2 * (s - 1)
+        return (h00*f0) + ((h10*h)*df0) + (h01*f1) + ((h11*h)*df1)
+
+    def locate_events(self,tolerance=1e-9):
+        ''' Events crossed during the last step taken
+
+        The sign of each event function is compared at both ends of the step
+        and each crossing is located by bisection on the dense output, so
+        finding an event costs no diff_eq evaluations beyond those dense()
+        may need once.  A function that is exactly zero at the start of the
+        step (e.g. after stopping at the event) does not trigger again.
+
+        Parameters
+        ----------
+        tolerance : optional float
+            Width of the final bracket around each crossing, relative to 
+            the step size.
+            default = 1e-9
+
+        Returns
+        -------
+        hits : list of (float, Event)
+            The location of each crossing and the entry of events that 
+            triggered it, earliest first.
+        '''
+        hits = []
+        if self._f_start is None:
+            return hits
+        x0 = self._x_start
+        x1 = self._x_last
+        for entry in self.events:
+            event = entry if isinstance(entry, Event) else Event(entry)
+            g0 = event(x0, self._f_start)
+            g1 = event(x1, self._f_last)
+            if g0 == 0 or g0*g1 > 0:
+                continue
+            if event.direction*(g1 - g0) < 0:
+                continue
+
+            x_event = x1
+            if g1 != 0:
+                bisection = search.Bisection(x0, x1, lambda x: event(x, self.dense(x)), decimals=15)
+                while abs(bisection.right - bisection.left) > tolerance*abs(x1 - x0):
+                    x_event, error = bisection.iterate()
+                    if error == 0:
+                        break
+                else:
+                    # Report the end of the bracket past the crossing
+                    x_event = bisection.right
+            hits.append((x_event, entry))
+
+        hits.sort(key=lambda hit: (hit[0] - x0) / (x1 - x0))
+        return hits
+
+    def _continues(self,x,f,params=None):
+        """True if (x, f) is exactly the state returned by the last step.
+
+        The state is compared by value since callers are free to modify it
+        in place between steps (jetpack impulses, static bodies, etc.).
+        """
+        return (self._f_last is not None
+                and x == self._x_last
+                and params is self._params_last
+                and np.shape(f) == np.shape(self._f_last)
+                and np.array_equal(f, self._f_last))
+
+    @staticmethod
+    def _combine(weights,k):
+        """Weighted sum of the stage derivatives, skipping zero weights."""
+        return sum(w * k_i for w, k_i in zip(weights, k) if w != 0)
                         
     def step(self,x,f,dx,params=None):
         ''' Advance a differential equation one step
@@ -52,6 +283,128 @@ class Solver(object):
         '''
         print("Solver.step is a stub!  This line should never be executed")
         return          # Do nothing, simply return.
+
+    def march(self,x,x_end,dx,step,max_steps=None):
+        ''' Take steps from x up to x_end, the last one shortened to land on it
+
+        Steps are of size dx, or of the solver's choosing (dx_next) for
+        adaptive solvers.  Each one is taken by calling step(x, h), which 
+        returns the independent variable where the step ended, so that 
+        callers stepping through a Physics object (the models) share the 
+        loop with integrate().
+
+        Parameters
+        ----------
+        x : float
+            The independent variable at the start
+
+        x_end : float
+            The independent variable at the end
+
+        dx : float
+            The step size (the first step size for adaptive solvers)
+
+        step : callable
+            step(x, h) takes a step of size h (or less, for adaptive 
+            solvers) from x and returns where it ended.
+
+        max_steps : optional int
+            Most steps to take.  FloatingPointError is raised if x_end is
+            not reached by then, e.g. by adaptive steps shrinking without
+            end near a collision.
+            default = None, no limit
+
+        Yields
+        ------
+        x : float
+            The independent variable at the end of each step, so that the
+            caller can look at the step (e.g. for events) and stop early.
+        '''
+        # Stop once within rounding error of x_end
+        tol = 1e-12 * max(1, abs(x_end))
+        steps = 0
+        while x_end - x > tol:
+            if steps == max_steps:
+                raise FloatingPointError(f"{type(self).__name__} took {max_steps} steps and is still at "
+                                         f"x = {x}, short of {x_end}")
+            h = dx
+            if self.adaptive and self.dx_next:
+                h = self.dx_next
+            x = step(x, min(h, x_end - x))
+            steps += 1
+            yield x
+
+    def integrate(self,x,f,x_end,dx,sample_dx,params=None,out=None):
+        ''' Integrate over an interval, sampling the solution at regular points
+
+        Steps of size dx (or of the solver's choosing, for adaptive solvers)
+        are taken up to x_end, the last one shortened to land on it.  The 
+        samples x, x + sample_dx, ... up to x_end are filled in from the
+        dense output of each step, so sampling does not affect the steps.
+
+        Parameters
+        ----------
+        x : float
+            The independent variable at the start
+
+        f : float or ndarray of floats
+            The dependent variables at the start
+
+        x_end : float
+            The independent variable at the end
+
+        dx : float
+            The step size (the first step size for adaptive solvers)
+
+        sample_dx : float
+            Spacing of the samples
+
+        params : optional object
+            A reference to an object containing non-state attributes for the 
+            differential equation
+            default = None
+
+        out : optional ndarray
+            Array of shape (T,) + shape(f) to write the T samples into, e.g.
+            an np.memmap for long runs.  Allocated if not given.
+            default = None
+
+        Returns
+        -------
+        xnext : float
+            The value of the independent variable at the end
+
+        fnext : float or ndarray of floats
+            The value of the dependent variable at the end
+
+        out : ndarray
+            The samples, one per row
+        '''
+        count = int(math.floor(((x_end - x) / sample_dx) + 1e-9)) + 1
+        if out is None:
+            out = np.empty((count,) + np.shape(f))
+        elif np.shape(out) != (count,) + np.shape(f):
+            raise ValueError(f"out has shape {np.shape(out)}, {(count,) + np.shape(f)} is needed")
+
+        def step(x, h):
+            nonlocal f
+            x, f = self.step(x, f, h, params)
+            return x
+
+        x0 = x
+        out[0] = f
+        k = 1
+        tol = 1e-12 * max(1, abs(x_end))
+        for x in self.march(x, x_end, dx, step):
+            # Samples within the step just taken
+            while k < count:
+                x_k = min(x0 + (k*sample_dx), x_end)
+                if x_k - x > tol:
+                    break
+                out[k] = f if abs(x_k - x) <= tol else self.dense(x_k)
+                k += 1
+
+        return x, f, out
                 
 
 class Euler(Solver):
@@ -77,8 +430,10 @@ class Euler(Solver):
         """
         See class Solver for full docstring
         """
+        df = self.diff_eq(x, f, params)
         xnext = x + dx
-        fnext = f + (dx * self.diff_eq(x, f, params))
+        fnext = f + (dx * df)
+        self._keep_step(x, f, xnext, fnext, params, df=df)
 
         return xnext, fnext
     
@@ -109,6 +464,7 @@ class RK2(Solver):
         k2 = self.diff_eq(x + (0.5*dx), f + (0.5*k1*dx), params)
         xnext = x + dx
         fnext = f + (k2*dx)
+        self._keep_step(x, f, xnext, fnext, params, df=k1)
 
         return xnext, fnext
     
@@ -122,25 +478,1735 @@ class RK4(Solver):
     ----------
     diff_eq : method
         Differential equation to solve.
+    inplace : bool
+        If True the state array is updated in place and returned, and the
+        stages are computed in a workspace that is kept between steps.  
+        diff_eq must accept an out argument (see Physics.diff_eq).  Stepping
+        a state of fixed shape then allocates no arrays.
+
+    dense() uses the cubic Hermite interpolant of class Solver.  The
+    derivative it evaluates at the end of a step is reused as the first
+    stage of the next one.
+
+    If the object diff_eq belongs to has an rk4_step(x, f, dx, params, out)
+    method (NBody with the numba backend), the step is handed to it 
+    whenever it returns a state rather than None.
 
     Methods
     -------
     step():
         see Solver class for full docstring.
     """
-    def __init__(self,diff_eq):
+    def __init__(self,diff_eq,inplace=False):
         super().__init__(diff_eq)
+        self.inplace = inplace
+        self._workspace = None
             
     def step(self,x,f,dx,params=None):
         """
         See class Solver for full docstring.
         """
-        k1 = self.diff_eq(x, f, params)
+        fused = getattr(getattr(self.diff_eq, '__self__', None), 'rk4_step', None)
+        if fused is not None:
+            result = self._step_fused(fused, x, f, dx, params)
+            if result is not None:
+                return result
+
+        if self.inplace:
+            return self._step_inplace(x, f, dx, params)
+
+        k1 = self._first_stage(x, f, params)
         k2 = self.diff_eq(x + (0.5*dx), f + (0.5*k1*dx), params)
         k3 = self.diff_eq(x + (0.5*dx), f + (0.5*k2*dx), params)
         k4 = self.diff_eq(x + dx, f + (k3*dx), params)
 
         xnext = x + dx
         fnext = f + (((k1 + (2*k2) + (2*k3) + k4) * dx) / 6)
+        self._keep_step(x, f, xnext, fnext, params, df=k1)
+
+        return xnext, fnext
+
+    def _first_stage(self,x,f,params,out=None):
+        """Derivative at the start of the step, reused from dense() if possible."""
+        if (self._df is not None) and (self._df[1] is not None) and self._continues(x, f, params):
+            if out is None:
+                return self._df[1]
+            np.copyto(out, self._df[1])
+            return out
+        if out is None:
+            return self.diff_eq(x, f, params)
+        return self.diff_eq(x, f, params, out=out)
+
+    def _step_fused(self,fused,x,f,dx,params):
+        """RK4 step taken by the physics' own kernel, None if it declines."""
+        out = None
+        if self.inplace:
+            if (self._workspace is None) or (self._workspace[0].shape != f.shape):
+                self._workspace = tuple(np.empty(f.shape) for i in range(5))
+            out = self._workspace[4]
+        fnext = fused(x, f, dx, params, out=out)
+        if fnext is None:
+            return None
+
+        self._keep_step(x, f, x + dx, fnext, params)
+        if self.inplace:
+            np.copyto(f, fnext)
+            fnext = f
+        return x + dx, fnext
+
+    def _step_inplace(self,x,f,dx,params):
+        """RK4 step that overwrites f, using preallocated stage buffers."""
+        if (self._workspace is None) or (self._workspace[0].shape != f.shape):
+            self._workspace = tuple(np.empty(f.shape) for i in range(5))
+        k1, k2, k3, k4, tmp = self._workspace
+
+        self._first_stage(x, f, params, out=k1)
+        np.multiply(k1, 0.5*dx, out=tmp)
+        tmp += f
+        self.diff_eq(x + (0.5*dx), tmp, params, out=k2)
+        np.multiply(k2, 0.5*dx, out=tmp)
+        tmp += f
+        self.diff_eq(x + (0.5*dx), tmp, params, out=k3)
+        np.multiply(k3, dx, out=tmp)
+        tmp += f
+        self.diff_eq(x + dx, tmp, params, out=k4)
+
+        # f += (k1 + 2*k2 + 2*k3 + k4) * dx/6, built in k2 so that the 
+        # step can be recorded before f is overwritten
+        k2 += k3
+        k2 *= 2
+        k2 += k1
+        k2 += k4
+        k2 *= dx/6
+        k2 += f
+        self._keep_step(x, f, x + dx, k2, params, df=k1)
+        np.copyto(f, k2)
+
+        return x + dx, f
+
+class RK45(Solver):
+    """
+    Dormand-Prince 5(4) embedded Runge-Kutta method with adaptive step size.
+
+    Each step is computed to fifth order and compared against the embedded 
+    fourth order solution.  The difference is used as an error estimate to
+    accept or reject the step and to pick the size of the next one.  The last
+    stage of an accepted step is the first stage of the next (FSAL), so an
+    accepted step costs six diff_eq evaluations.
+
+    dense() uses the fourth order continuous extension of the method, which
+    needs no further evaluations.
+
+    ...
+
+    Attributes
+    ----------
+    diff_eq : method
+        Differential equation to solve.
+    rtol : float
+        Relative error tolerance per step.
+    atol : float
+        Absolute error tolerance per step.
+    dx_min : float
+        Smallest step the solver will try.  A step of this size is accepted
+        regardless of its error estimate so that integration can always
+        make progress (e.g. through a near collision), but not more than
+        max_forced times in a row, nor when the estimate is not finite:
+        step() then raises FloatingPointError.
+    dx_next : float or None
+        Suggested size of the next step, None until the first step is taken.
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    adaptive = True
+
+    # Butcher tableau
+    c = np.array([0, 1/5, 3/10, 4/5, 8/9, 1, 1])
+    a = [[],
+         [1/5],
+         [3/40, 9/40],
+         [44/45, -56/15, 32/9],
+         [19372/6561, -25360/2187, 64448/6561, -212/729],
+         [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656]]
+    b = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0])
+    # Difference between the 5th and the embedded 4th order weights
+    e = np.array([71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40])
+    # Dense output weights (Hairer, Norsett & Wanner)
+    d = np.array([-12715105075/11282082432, 0, 87487479700/32700410799, 
+                  -10690763975/1880347072, 701980252875/199316789632, 
+                  -1453857185/822651844, 69997945/29380423])
+
+    safety = 0.9
+    min_factor = 0.2
+    max_factor = 5.0
+    max_forced = 100    # steps of dx_min accepted in a row over the tolerance
+
+    def __init__(self,diff_eq,rtol=1e-6,atol=1e-6,dx_min=1e-9):
+        super().__init__(diff_eq)
+        self.rtol = rtol
+        self.atol = atol
+        self.dx_min = dx_min
+        self.dx_next = None
+        self._k_last = None
+        self._k_step = None
+        self._forced = 0
+
+    def step(self,x,f,dx,params=None):
+        """
+        See class Solver for full docstring.
+
+        The step is first attempted with size dx and shrunk until the error 
+        estimate is within tolerance, so xnext may fall short of x + dx.
+        """
+        if self._continues(x, f, params):
+            k1 = self._k_last
+        else:
+            k1 = self.diff_eq(x, f, params)
+
+        h = dx
+        while True:
+            k = [k1]
+            for i in range(1, 6):
+                k.append(self.diff_eq(x + (self.c[i]*h), f + (h*self._combine(self.a[i], k)), params))
+            # The 7th stage is evaluated at the 5th order solution
+            fnext = f + (h*self._combine(self.b, k))
+            k.append(self.diff_eq(x + h, fnext, params))
+
+            err_vec = h * self._combine(self.e, k)
+            scale = self.atol + (self.rtol * np.maximum(np.abs(f), np.abs(fnext)))
+            err = np.max(np.abs(err_vec) / scale)
+
+            if err <= 1:
+                self._forced = 0
+                break
+            if abs(h) <= self.dx_min:
+                if not np.isfinite(err):
+                    raise FloatingPointError(f"RK45 error estimate is {err} at x = {x}, even for a step of dx_min")
+                self._forced += 1
+                if self._forced > self.max_forced:
+                    raise FloatingPointError(f"RK45 took {self.max_forced} steps of dx_min = {self.dx_min} "
+                                             f"over the tolerance in a row, at x = {x}")
+                break
+
+            # Rejected, shrink the step and try again
+            if np.isfinite(err):
+                factor = max(self.min_factor, self.safety * err**(-1/5))
+            else:
+                factor = self.min_factor
+            h = np.sign(h) * max(abs(h) * factor, self.dx_min)
+
+        if err == 0:
+            factor = self.max_factor
+        else:
+            factor = min(self.max_factor, max(self.min_factor, self.safety * err**(-1/5)))
+        self.dx_next = h * factor
+
+        xnext = x + h
+        self._k_last = k[6]
+        self._k_step = k
+        self._keep_step(x, f, xnext, fnext, params, df=k[0], dfnext=k[6])
+
+        return xnext, fnext
+
+    def dense(self,x):
+        """
+        See class Solver for full docstring.
+        """
+        if self._f_start is None:
+            raise RuntimeError("dense() needs a step to interpolate")
+        h = self._x_last - self._x_start
+        s = (x - self._x_start) / h
+        f0 = self._f_start
+        k = self._k_step
+
+        diff = self._f_last - f0
+        r3 = (h*k[0]) - diff
+        r4 = diff - (h*k[6]) - r3
+        r5 = h*self._combine(self.d, k)
+        return f0 + (s*(diff + ((1 - s)*(r3 + (s*(r4 + ((1 - s)*r5)))))))
+
+class AdamsBashforthMoulton(Solver):
+    """
+    Adams-Bashforth-Moulton predictor-corrector multistep method.
+
+    The derivatives at the last few steps are kept in a ring buffer.  Each 
+    step predicts the new state with the explicit Adams-Bashforth formula,
+    evaluates the derivative there and corrects with the implicit Adams-
+    Moulton formula, so it costs two diff_eq evaluations (PECE) or one (PEC,
+    the derivative at the predicted state being kept instead of evaluating
+    it again at the corrected one) against RK4's four.
+
+    The weights are computed for the actual spacing of the history, so the
+    step size may change between steps (e.g. the shortened last step of
+    NModel.advance) without losing it.  The history is restarted whenever
+    the state passed in is not the one returned by the last step (see
+    Solver._continues), e.g. after a jetpack impulse or a portal teleport
+    changed it in place, as the derivative then jumps.  It is rebuilt with
+    RK4 steps, which cost four evaluations each.
+
+    ...
+
+    Attributes
+    ----------
+    diff_eq : method
+        Differential equation to solve.
+    order : int
+        Order of the method, the number of derivatives kept.
+    mode : str
+        'PECE' or 'PEC'.
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    restart():
+        Forget the history.
+    """
+    max_weights = 16    # number of node spacings whose weights are cached
+
+    def __init__(self,diff_eq,order=4,mode='PECE'):
+        super().__init__(diff_eq)
+        if mode not in ('PECE', 'PEC'):
+            raise ValueError(f"mode must be 'PECE' or 'PEC', not {mode!r}")
+        self.order = order
+        self.mode = mode
+        self._x_hist = np.empty(order)
+        self._df_hist = None
+        self._head = -1     # index of the newest entry of the ring buffer
+        self._count = 0     # number of entries in use
+        self._weights = collections.OrderedDict()
+
+    def restart(self):
+        """Forget the history, e.g. after changing the state of the bodies."""
+        self._count = 0
+
+    def _push(self,x,df):
+        """Add a derivative to the history, overwriting the oldest."""
+        if (self._df_hist is None) or (self._df_hist.shape[1:] != np.shape(df)):
+            self._df_hist = np.empty((self.order,) + np.shape(df))
+            self._count = 0
+        self._head = (self._head + 1) % self.order
+        self._x_hist[self._head] = x
+        self._df_hist[self._head] = df
+        self._count = min(self._count + 1, self.order)
+
+    def _history(self,k):
+        """Ring buffer indices of the k newest entries, newest first."""
+        return [(self._head - i) % self.order for i in range(k)]
+
+    def _quadrature(self,nodes):
+        """Weights integrating the interpolant through nodes over [0, 1].
+
+        nodes are in units of the step, relative to its start.  Steps of
+        constant size give the same nodes every time, so the weights are
+        cached by their rounded values, for the max_weights spacings used
+        last (steps of ever changing size would otherwise fill it up).
+        """
+        key = tuple(np.round(nodes, 10))
+        weights = self._weights.get(key)
+        if weights is None:
+            k = len(nodes)
+            vandermonde = np.vander(nodes, k, increasing=True).T
+            weights = np.linalg.solve(vandermonde, 1 / np.arange(1, k + 1))
+            self._weights[key] = weights
+            if len(self._weights) > self.max_weights:
+                self._weights.popitem(last=False)
+        else:
+            self._weights.move_to_end(key)
+        return weights
+
+    @staticmethod
+    def _sum(weights,past):
+        """Weighted sum of the derivatives in past, one per row."""
+        return (weights @ past.reshape(len(weights), -1)).reshape(past.shape[1:])
+
+    def _rk4(self,x,f,dx,df,params):
+        """RK4 step from a known first stage, to build up the history."""
+        k2 = self.diff_eq(x + (0.5*dx), f + (0.5*df*dx), params)
+        k3 = self.diff_eq(x + (0.5*dx), f + (0.5*k2*dx), params)
+        k4 = self.diff_eq(x + dx, f + (k3*dx), params)
+        return f + (((df + (2*k2) + (2*k3) + k4) * dx) / 6)
+
+    def step(self,x,f,dx,params=None):
+        """
+        See class Solver for full docstring.
+        """
+        if not self._continues(x, f, params):
+            self._count = 0
+        if self._count == 0:
+            self._push(x, self.diff_eq(x, f, params))
+        df = self._df_hist[self._head]
+        xnext = x + dx
+
+        exact = True        # dfnext is the derivative at fnext
+        if self._count < self.order:
+            fnext = self._rk4(x, f, dx, df, params)
+            dfnext = self.diff_eq(xnext, fnext, params)
+        else:
+            newest = self._history(self.order)
+            nodes = (self._x_hist[newest] - x) / dx
+            past = self._df_hist[newest]
+
+            # Predict
+            weights = self._quadrature(nodes) * dx
+            fnext = f + self._sum(weights, past)
+            dfnext = self.diff_eq(xnext, fnext, params)
+
+            # Correct, with the predicted derivative and all but the oldest
+            weights = self._quadrature(np.concatenate(([1.0], nodes[:-1]))) * dx
+            fnext = f + (weights[0]*dfnext) + self._sum(weights[1:], past[:-1])
+            if self.mode == 'PECE':
+                dfnext = self.diff_eq(xnext, fnext, params)
+            else:
+                exact = False
+
+        self._push(xnext, dfnext)
+        self._keep_step(x, f, xnext, fnext, params, df=df, dfnext=dfnext if exact else None)
+
+        return xnext, fnext
+
+class Composition(Solver):
+    """
+    Base class for symplectic integrators built from drift and kick substeps.
+
+    The state must be laid out as [pos | vel] along its last axis, as in 
+    GravPhobjects.state, and the acceleration must depend on position only.
+    A step alternates kicks and drifts,
+
+        kick d[0], drift c[0], kick d[1], ..., drift c[-1], kick d[-1]
+
+    where a kick of weight w advances the velocity by w*dx*accel and a drift
+    advances the position by w*dx*vel.  Zero weights are skipped.  The
+    acceleration is only evaluated when the positions have moved, and when
+    a step ends in a kick its acceleration is reused by the next step.
+
+    ...
+
+    Attributes
+    ----------
+    accel : method
+        Acceleration function accel(t, pos, params) (see Physics.accel).
+    c : sequence of floats
+        Drift weights (sum to one).
+    d : sequence of floats
+        Kick weights, one more than the drifts (sum to one).
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    callback = 'accel'
+    c = []
+    d = []
+
+    def __init__(self,accel):
+        super().__init__(accel)
+        self.accel = accel
+        self._a_last = None
+
+    @staticmethod
+    def from_leapfrog(weights):
+        """Drift and kick weights of a sequence of leapfrog substeps.
+
+        Each substep of relative size w is kick w/2, drift w, kick w/2.
+        Neighbouring kicks are merged.
+
+        Returns
+        -------
+        c, d : lists of floats
+            Drift and kick weights
+        """
+        c = list(weights)
+        d = [0.5*weights[0]]
+        d += [0.5*(w1 + w2) for w1, w2 in zip(weights[:-1], weights[1:])]
+        d += [0.5*weights[-1]]
+        return c, d
+
+    def step(self,x,f,dx,params=None):
+        """
+        See class Solver for full docstring.
+        """
+        n = np.shape(f)[-1] // 2
+        if self._continues(x, f, params):
+            a = self._a_last
+        else:
+            a = None
+
+        fnext = np.array(f, dtype=float)
+        xnow = x
+        a_start = None
+        for i, d_i in enumerate(self.d):
+            if d_i != 0:
+                if a is None:
+                    a = self.accel(xnow, fnext[...,:n], params)
+                if i == 0:
+                    a_start = a
+                fnext[...,n:] += d_i*dx*a       # kick
+            if i < len(self.c) and self.c[i] != 0:
+                fnext[...,:n] += self.c[i]*dx*fnext[...,n:]     # drift
+                xnow = xnow + (self.c[i]*dx)
+                a = None
+
+        xnext = x + dx
+        self._a_last = a
+        self._keep_step(x, f, xnext, fnext, params,
+                        df=self._with_velocity(f, a_start), dfnext=self._with_velocity(fnext, a))
+
+        return xnext, fnext
+
+class Leapfrog(Composition):
+    """
+    Kick-drift-kick leapfrog (velocity Verlet) for second order systems.
+
+    Second order and symplectic, so the energy error stays bounded over
+    long runs instead of drifting.  Each step costs one acceleration 
+    evaluation since the acceleration at the end of a step is reused by 
+    the next.
+    See class Composition for the requirements on the state.
+
+    ...
+
+    Attributes
+    ----------
+    accel : method
+        Acceleration function accel(t, pos, params).
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    c = [1]
+    d = [0.5, 0.5]
+
+class ForestRuth(Composition):
+    """
+    Forest-Ruth fourth order symplectic integrator.
+
+    Drift-kick-drift form, three acceleration evaluations per step.  See class 
+    Composition for the requirements on the state.
+
+    ...
+
+    Attributes
+    ----------
+    accel : method
+        Acceleration function accel(t, pos, params).
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    theta = 1 / (2 - 2**(1/3))
+    c = [theta/2, (1 - theta)/2, (1 - theta)/2, theta/2]
+    d = [0, theta, 1 - 2*theta, theta, 0]
+
+class Yoshida4(Composition):
+    """
+    Yoshida's fourth order symplectic integrator.
+
+    Three leapfrog substeps (the "triple jump"), three acceleration 
+    evaluations per step.  See class Composition for the requirements on the state.
+
+    ...
+
+    Attributes
+    ----------
+    accel : method
+        Acceleration function accel(t, pos, params).
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    w1 = 1 / (2 - 2**(1/3))
+    w0 = 1 - 2*w1
+    c, d = Composition.from_leapfrog([w1, w0, w1])
+
+class Yoshida6(Composition):
+    """
+    Yoshida's sixth order symplectic integrator (solution A).
+
+    Seven leapfrog substeps, seven acceleration evaluations per step.  See class
+    Composition for the requirements on the state.
+
+    ...
+
+    Attributes
+    ----------
+    accel : method
+        Acceleration function accel(t, pos, params).
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    w1 = -1.17767998417887
+    w2 = 0.235573213359357
+    w3 = 0.784513610477560
+    w0 = 1 - 2*(w1 + w2 + w3)
+    c, d = Composition.from_leapfrog([w3, w2, w1, w0, w1, w2, w3])
+
+class LogHLeapfrog(Solver):
+    """
+    Time-transformed (logarithmic Hamiltonian) leapfrog.
+
+    The leapfrog is applied to the system in a fictitious time s with 
+    dt/ds = 1/U, U being minus the potential energy, which is large only 
+    when bodies are close together.  Steps of constant size in s are then
+    short in time near a close approach and long everywhere else, while the
+    map stays symplectic (Mikkola & Tanikawa 1999, Preto & Tremaine 1999):
+
+        drift ds/2, kick ds, drift ds/2
+
+    where a drift moves the positions and the time with dt = (ds/2)/(T + B),
+    T being the kinetic energy and B = U - T its value at the start (minus
+    the total energy), and a kick changes the velocities by (ds/U)*accel.
+    Kepler orbits are followed exactly apart from a phase error, however
+    eccentric.
+
+    The Physics object supplies the masses, the accelerations and the
+    potential energy through energy_split(params).  The state must be laid
+    out as [pos | vel] along its last axis and hold a single system (no
+    batch axis).  B is reset whenever the state passed in is not the one
+    returned by the last step, e.g. after a jetpack impulse.
+
+    Steps are taken in time as long as they fit before x + dx, so dx_next
+    is infinite once the first step has been taken.  The step that would
+    overshoot is shortened in s to land on x + dx (secant method, a few
+    extra evaluations).  dense() uses the cubic Hermite interpolant of
+    class Solver.
+
+    Without potential energy (a single body) there is nothing to transform
+    time by, and plain leapfrog steps of dx are taken in time instead, with
+    dx_next None so that callers keep bounding their size.
+
+    ...
+
+    Attributes
+    ----------
+    energy_split : method
+        See NBody.energy_split.
+    ds : float or None
+        Step in fictitious time.  If None it is set on the first step so 
+        that it lasts dx in time.
+    dx_next : float or None
+        Infinite after a step in fictitious time, None otherwise.
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    adaptive = True
+    callback = 'energy_split'
+
+    max_iterations = 50
+
+    def __init__(self,energy_split,ds=None):
+        super().__init__(energy_split)
+        self.energy_split = energy_split
+        self.ds = ds
+        self.dx_next = None
+        self._binding = None
+
+    def _derivative(self,x,f,params=None):
+        """Derivative of the state, for dense()."""
+        m, accel, potential = self.energy_split(params)
+        n = np.shape(f)[-1] // 2
+        return self._with_velocity(f, accel(x, f[...,:n]))
+
+    @staticmethod
+    def _kinetic(m,vel):
+        """Kinetic energy of the bodies."""
+        return 0.5 * np.sum(m * np.sum(vel**2, axis=-1))
+
+    def _map(self,x,f,h,split):
+        """Drift-kick-drift over h in fictitious time, returning the time elapsed and the new state."""
+        m, accel, potential = split
+        n = np.shape(f)[-1] // 2
+        pos = f[...,:n]
+        vel = f[...,n:]
+
+        dt_start = 0.5*h / (self._kinetic(m, vel) + self._binding)
+        pos = pos + (dt_start*vel)
+        vel = vel + ((h / -potential(pos)) * accel(x + dt_start, pos))
+        dt_end = 0.5*h / (self._kinetic(m, vel) + self._binding)
+        pos = pos + (dt_end*vel)
+
+        return dt_start + dt_end, np.concatenate((pos, vel), axis=-1)
+
+    @staticmethod
+    def _leapfrog(x,f,dx,accel):
+        """Drift-kick-drift over dx in time, for a system without potential energy."""
+        n = np.shape(f)[-1] // 2
+        pos = f[...,:n] + ((0.5*dx)*f[...,n:])
+        vel = f[...,n:] + (dx*accel(x + (0.5*dx), pos))
+        pos = pos + ((0.5*dx)*vel)
+        return np.concatenate((pos, vel), axis=-1)
+
+    def step(self,x,f,dx,params=None):
+        """
+        See class Solver for full docstring.
+
+        xnext is x + dx only when the step has to be shortened to not 
+        overshoot it.
+        """
+        split = self.energy_split(params)
+        m, accel, potential = split
+        n = np.shape(f)[-1] // 2
+        U = -potential(f[...,:n])
+        if not U > 0:
+            # Nothing to transform time by
+            fnext = self._leapfrog(x, f, dx, accel)
+            self._binding = None
+            self.dx_next = None
+            self._keep_step(x, f, x + dx, fnext, params)
+            return x + dx, fnext
+
+        if (self._binding is None) or not self._continues(x, f, params):
+            self._binding = U - self._kinetic(m, f[...,n:])
+        if self.ds is None:
+            self.ds = dx * U
+
+        dt, fnext = self._map(x, f, self.ds, split)
+        if dt > dx:
+            # Shorten the step in s until it ends at x + dx
+            fnext = _land(lambda h: self._map(x, f, h, split), self.ds, dt, fnext, dx, self.max_iterations)
+            dt = dx
+
+        xnext = x + dt
+        self.dx_next = math.inf
+        self._keep_step(x, f, xnext, fnext, params)
+
+        return xnext, fnext
+
+class RKN(Solver):
+    """
+    Base class for Runge-Kutta-Nystrom methods.
+
+    Runge-Kutta methods specialised to second order systems x'' = a(t, x).
+    The state must be laid out as [pos | vel] along its last axis, as in 
+    GravPhobjects.state.  Only the acceleration is evaluated and only the
+    positions are built for each stage, the velocity half of the derivative
+    (which just copies the velocity) is never formed.
+
+        X_i = x + c_i*h*v + h**2 * sum_j a_ij k_j,   k_i = a(t + c_i*h, X_i)
+        x_next = x + h*v + h**2 * sum_i bbar_i k_i
+        v_next = v + h * sum_i b_i k_i
+
+    ...
+
+    Attributes
+    ----------
+    accel : method
+        Acceleration function accel(t, pos, params) (see Physics.accel).
+    c, a, bbar, b : sequences of floats
+        The Nystrom tableau.
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    callback = 'accel'
+    c = []
+    a = []
+    bbar = []
+    b = []
+
+    def __init__(self,accel):
+        super().__init__(accel)
+        self.accel = accel
+
+    def step(self,x,f,dx,params=None):
+        """
+        See class Solver for full docstring.
+        """
+        n = np.shape(f)[-1] // 2
+        pos = f[...,:n]
+        vel = f[...,n:]
+
+        k = []
+        for c_i, a_i in zip(self.c, self.a):
+            if len(k) == 0:
+                stage_pos = pos
+            else:
+                stage_pos = pos + (c_i*dx*vel) + ((dx**2)*self._combine(a_i, k))
+            k.append(self.accel(x + (c_i*dx), stage_pos, params))
+
+        pos_next = pos + (dx*vel) + ((dx**2)*self._combine(self.bbar, k))
+        vel_next = vel + (dx*self._combine(self.b, k))
+
+        xnext = x + dx
+        fnext = np.concatenate((pos_next, vel_next), axis=-1)
+        df = self._with_velocity(f, k[0]) if self.c[0] == 0 else None
+        self._keep_step(x, f, xnext, fnext, params, df=df)
+
+        return xnext, fnext
+
+class RKN4(RKN):
+    """
+    Fourth order Runge-Kutta-Nystrom method.
+
+    Three acceleration evaluations per step, against four full diff_eq
+    evaluations for RK4.  See class RKN for details.
+
+    ...
+
+    Attributes
+    ----------
+    accel : method
+        Acceleration function accel(t, pos, params).
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    c = [0, 1/2, 1]
+    a = [[],
+         [1/8],
+         [0, 1/2]]
+    bbar = [1/6, 1/3, 0]
+    b = [1/6, 4/6, 1/6]
+
+class RKN5(RKN):
+    """
+    Fifth order Runge-Kutta-Nystrom method.
+
+    Four acceleration evaluations per step.  See class RKN for details.
+
+    ...
+
+    Attributes
+    ----------
+    accel : method
+        Acceleration function accel(t, pos, params).
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    c = [0, 1/5, 2/3, 1]
+    a = [[],
+         [1/50],
+         [-1/27, 7/27],
+         [3/10, -2/35, 9/35]]
+    bbar = [14/336, 100/336, 54/336, 0]
+    b = [14/336, 125/336, 162/336, 35/336]
+
+class Hermite(Solver):
+    """
+    Fourth order Hermite predictor-corrector for N-body systems.
+
+    Uses the acceleration and its time derivative (the jerk) at both ends of
+    the step.  The state is predicted with a Taylor series, the acceleration
+    and jerk are evaluated at the predicted state and the step is corrected
+    with the Hermite interpolant through both ends.  The state must be laid
+    out as [pos | vel] along its last axis, as in GravPhobjects.state.
+
+    The acceleration and jerk at the predicted state are kept for the start
+    of the next step, so a step costs one accel_jerk evaluation (plus one
+    per additional corrector iteration).
+
+    ...
+
+    Attributes
+    ----------
+    accel_jerk : method
+        Function accel_jerk(t, pos, vel, params) returning the acceleration
+        and the jerk (see NBody.accel_jerk).
+    iterations : int
+        Number of evaluate-correct passes, P(EC)^n, at least 1.  1 is the
+        usual PEC scheme.
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    callback = 'accel_jerk'
+
+    def __init__(self,accel_jerk,iterations=1):
+        super().__init__(accel_jerk)
+        if iterations < 1:
+            raise ValueError(f"iterations must be at least 1, not {iterations}")
+        self.accel_jerk = accel_jerk
+        self.iterations = iterations
+        self._aj_last = None
+
+    def step(self,x,f,dx,params=None):
+        """
+        See class Solver for full docstring.
+        """
+        n = np.shape(f)[-1] // 2
+        pos0 = f[...,:n]
+        vel0 = f[...,n:]
+        if self._continues(x, f, params):
+            a0, j0 = self._aj_last
+        else:
+            a0, j0 = self.accel_jerk(x, pos0, vel0, params)
+
+        # Predict
+        pos = pos0 + (dx*vel0) + ((dx**2/2)*a0) + ((dx**3/6)*j0)
+        vel = vel0 + (dx*a0) + ((dx**2/2)*j0)
+
+        # Evaluate and correct
+        xnext = x + dx
+        for i in range(self.iterations):
+            a1, j1 = self.accel_jerk(xnext, pos, vel, params)
+            vel = vel0 + ((dx/2)*(a0 + a1)) + ((dx**2/12)*(j0 - j1))
+            pos = pos0 + ((dx/2)*(vel0 + vel)) + ((dx**2/12)*(a0 - a1))
+
+        fnext = np.concatenate((pos, vel), axis=-1)
+        self._aj_last = (a1, j1)
+        self._keep_step(x, f, xnext, fnext, params,
+                        df=self._with_velocity(f, a0), dfnext=self._with_velocity(fnext, a1))
+
+        return xnext, fnext
+
+class BlockHermite(Solver):
+    """
+    Fourth order Hermite integrator with individual block time steps.
+
+    Every body moves on its own time step, dx / 2**level, chosen from its
+    acceleration and its derivatives (Aarseth's criterion).  Bodies sharing
+    the next update time form the active block.  All bodies are predicted to
+    that time, but only the active block's accelerations and jerks are
+    recomputed and corrected, so a close encounter only shrinks the steps
+    of the bodies taking part in it.  A step only grows when the body's time
+    is a multiple of the larger step, and never beyond dx, so every body
+    arrives exactly at x + dx and the returned state is synchronised.
+
+    The state must be laid out as [pos | vel] along its last axis, as in
+    GravPhobjects.state.  Each body's level is kept for the next step.
+
+    ...
+
+    Attributes
+    ----------
+    accel_jerk : method
+        Function accel_jerk(t, pos, vel, params, active) returning the 
+        acceleration and the jerk of the active bodies (see NBody.accel_jerk).
+    eta : float
+        Accuracy parameter of the time step criterion.
+    eta_start : float
+        Accuracy parameter for the first step, taken from |a|/|j|.
+    max_level : int
+        Deepest level, i.e. the smallest step is dx / 2**max_level.
+    evaluations : int
+        Number of bodies whose acceleration and jerk have been evaluated.
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    callback = 'accel_jerk'
+
+    def __init__(self,accel_jerk,eta=0.01,eta_start=0.01,max_level=20):
+        super().__init__(accel_jerk)
+        self.accel_jerk = accel_jerk
+        self.eta = eta
+        self.eta_start = eta_start
+        self.max_level = max_level
+        self.evaluations = 0
+        self._aj_last = None
+        self._level = None
+
+    def _to_level(self,dx,dt):
+        """Smallest level whose step dx / 2**level does not exceed dt."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            level = np.ceil(np.log2(dx / dt))
+        level = np.where(np.isfinite(level), level, 0)
+        return np.clip(level, 0, self.max_level).astype(int)
+
+    def step(self,x,f,dx,params=None):
+        """
+        See class Solver for full docstring.
+        """
+        n = np.shape(f)[-1] // 2
+        pos = np.array(f[...,:n], dtype=float)
+        vel = np.array(f[...,n:], dtype=float)
+        if self._continues(x, f, params):
+            a, j = self._aj_last
+            level = self._level.copy()
+        else:
+            a, j = self.accel_jerk(x, pos, vel, params)
+            self.evaluations += len(pos)
+            dt = self.eta_start * (np.linalg.norm(a, axis=-1) / np.linalg.norm(j, axis=-1))
+            level = self._to_level(dx, dt)
+        df = self._with_velocity(f, a)
+
+        # Times are counted in integer ticks of the smallest step
+        end = 2**self.max_level
+        tick = dx / end
+        ticks = np.zeros(len(pos), dtype=np.int64)
+
+        while ticks.min() < end:
+            t_due = ticks + 2**(self.max_level - level)
+            t_block = t_due.min()
+            active = np.nonzero(t_due == t_block)[0]
+
+            # Predict everyone to the block time
+            tau = ((t_block - ticks) * tick)[:,None]
+            pos_p = pos + (tau*vel) + ((tau**2/2)*a) + ((tau**3/6)*j)
+            vel_p = vel + (tau*a) + ((tau**2/2)*j)
+
+            # Evaluate and correct the active block
+            a1, j1 = self.accel_jerk(x + (t_block*tick), pos_p, vel_p, params, active)
+            self.evaluations += len(active)
+            a0 = a[active]
+            j0 = j[active]
+            h = tau[active]
+            vel1 = vel[active] + ((h/2)*(a0 + a1)) + ((h**2/12)*(j0 - j1))
+            pos1 = pos[active] + ((h/2)*(vel[active] + vel1)) + ((h**2/12)*(a0 - a1))
+
+            # Higher derivatives at the end of the step for the next time step
+            a3 = (12*(a0 - a1) + (6*h*(j0 + j1))) / h**3
+            a2 = ((-6*(a0 - a1) - (h*((4*j0) + (2*j1)))) / h**2) + (h*a3)
+            a1_n = np.linalg.norm(a1, axis=-1)
+            j1_n = np.linalg.norm(j1, axis=-1)
+            a2_n = np.linalg.norm(a2, axis=-1)
+            a3_n = np.linalg.norm(a3, axis=-1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dt = np.sqrt(self.eta * ((a1_n*a2_n) + j1_n**2) / ((j1_n*a3_n) + a2_n**2))
+            new_level = self._to_level(dx, dt)
+
+            # Grow by at most one level, and only when the times line up
+            old_level = level[active]
+            can_grow = (old_level > 0) & (t_block % (2**(self.max_level - old_level + 1)) == 0)
+            new_level = np.maximum(new_level, np.where(can_grow, old_level - 1, old_level))
+
+            pos[active] = pos1
+            vel[active] = vel1
+            a[active] = a1
+            j[active] = j1
+            ticks[active] = t_block
+            level[active] = new_level
+
+        xnext = x + dx
+        fnext = np.concatenate((pos, vel), axis=-1)
+        self._aj_last = (a, j)
+        self._level = level
+        self._keep_step(x, f, xnext, fnext, params, df=df, dfnext=self._with_velocity(fnext, a))
+
+        return xnext, fnext
+
+class IAS15(Solver):
+    """
+    15th order Gauss-Radau integrator with adaptive step size (IAS15).
+
+    For second order systems x'' = a(t, x).  Over a step the acceleration is
+    represented as a 7th degree polynomial in the step fraction, fitted to 
+    the acceleration at the 7 Gauss-Radau nodes by a predictor-corrector
+    iteration.  Positions and velocities follow by integrating it exactly.
+    The size of the highest order coefficient sets the next step so that the
+    error per step stays around epsilon, and the sums that update the state
+    are compensated (Kahan summation) so that round-off does not accumulate.
+    Meant for offline runs that need trajectories accurate to machine
+    precision; each iteration costs 7 acceleration evaluations, but the steps
+    are very large.  dense() evaluates the same polynomial inside the step.
+
+    The state must be laid out as [pos | vel] along its last axis, as in
+    GravPhobjects.state.
+
+    ...
+
+    Attributes
+    ----------
+    accel : method
+        Acceleration function accel(t, pos, params) (see Physics.accel).
+    epsilon : float
+        Error per step the step size control aims for.
+    dx_min : float
+        Smallest step the solver will try (accepted regardless of error).
+    dx_next : float or None
+        Suggested size of the next step, None until the first step is taken.
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    adaptive = True
+    callback = 'accel'
+
+    # Gauss-Radau nodes as fractions of the step
+    h = np.array([0.0, 0.0562625605369221464656521910318, 0.180240691736892364987579942780,
+                  0.352624717113169637373907769648, 0.547153626330555383001448554766,
+                  0.734210177215410531523210605558, 0.885320946839095768090359771030,
+                  0.977520613561287501891174488626])
+
+    # The acceleration is fitted in Newton form,
+    #     a(s) = a0 + g1*s + g2*s*(s - h1) + g3*s*(s - h1)*(s - h2) + ...
+    # C converts the g coefficients to power series coefficients b, a(s) = a0 + sum b_k s**k
+    C = np.zeros((7, 7))
+    for k in range(7):
+        basis = np.polynomial.polynomial.polyfromroots(h[:k+1])
+        C[:k+1, k] = basis[1:]
+    del k, basis
+
+    safety = 0.25
+    max_iterations = 12
+
+    def __init__(self,accel,epsilon=1e-9,dx_min=1e-12):
+        super().__init__(accel)
+        self.accel = accel
+        self.epsilon = epsilon
+        self.dx_min = dx_min
+        self.dx_next = None
+        self._b_next = None
+        self._comp = None
+        self._poly = None
+
+    @staticmethod
+    def _kahan(value,increment,comp):
+        """Compensated value + increment, returning the new value and compensation."""
+        y = increment - comp
+        total = value + y
+        comp = (total - value) - y
+        return total, comp
+
+    def _predict(self,pos,vel,a0,b,dx,s):
+        """Position and velocity at step fraction s from the polynomial b."""
+        k = np.arange(1, 8)
+        pos_coef = a0/2 + np.tensordot(s**k / ((k + 1)*(k + 2)), b, axes=1)
+        vel_coef = a0 + np.tensordot(s**k / (k + 1), b, axes=1)
+        pos_s = pos + (s*dx*vel) + (((s*dx)**2)*pos_coef)
+        vel_s = vel + ((s*dx)*vel_coef)
+        return pos_s, vel_s
+
+    def step(self,x,f,dx,params=None):
+        """
+        See class Solver for full docstring.
+
+        The step is first attempted with size dx and shrunk until the error 
+        estimate is acceptable, so xnext may fall short of x + dx.
+        """
+        n = np.shape(f)[-1] // 2
+        pos = np.array(f[...,:n], dtype=float)
+        vel = np.array(f[...,n:], dtype=float)
+        a0 = self.accel(x, pos, params)
+        if self._continues(x, f, params):
+            # Rescale the prediction if the step differs from the suggested one
+            q = dx / self.dx_next
+            b = self._b_next * (q**np.arange(1, 8)).reshape((7,) + (1,)*np.ndim(pos))
+            comp_pos, comp_vel = self._comp
+        else:
+            b = np.zeros((7,) + np.shape(pos))
+            comp_pos = np.zeros_like(pos)
+            comp_vel = np.zeros_like(vel)
+
+        while True:
+            g = np.linalg.solve(self.C, b.reshape(7, -1)).reshape(b.shape)
+            b7_change = np.inf
+            for iteration in range(self.max_iterations):
+                b7_old = np.copy(b[6])
+                b7_change_last = b7_change
+                for i in range(1, 8):
+                    pos_i, vel_i = self._predict(pos, vel, a0, b, dx, self.h[i])
+                    a_i = self.accel(x + (self.h[i]*dx), pos_i, params)
+                    # Divided difference for the i-th Newton coefficient
+                    gi = (a_i - a0) / self.h[i]
+                    for k in range(1, i):
+                        gi = (gi - g[k-1]) / (self.h[i] - self.h[k])
+                    g[i-1] = gi
+                    b = np.tensordot(self.C, g, axes=1)
+                a_scale = np.max(np.abs(a_i))
+                b7_change = np.max(np.abs(b[6] - b7_old)) / a_scale if a_scale > 0 else 0
+                # Converged, or stuck at round-off level
+                if b7_change < 1e-16 or (iteration > 1 and b7_change >= b7_change_last):
+                    break
+
+            # Step size control from the size of the last coefficient
+            a_scale = np.max(np.abs(a_i))
+            err = np.max(np.abs(b[6])) / a_scale if a_scale > 0 else 0
+            if err > 0 and np.isfinite(err):
+                dx_new = dx * (self.epsilon / err)**(1/7)
+            elif err == 0:
+                dx_new = dx / self.safety
+            else:
+                dx_new = dx * self.safety
+            if abs(dx_new) >= self.safety*abs(dx) or abs(dx) <= self.dx_min:
+                break
+            # Rejected, retry with the smaller step
+            dx = np.sign(dx) * max(abs(dx_new), self.dx_min)
+            b = np.zeros_like(b)
+
+        # Accept: integrate the polynomial over the whole step
+        self._poly = (pos, vel, a0, b, dx)
+        k = np.arange(1, 8)
+        dpos = (dx*vel) + ((dx**2)*(a0/2 + np.tensordot(1 / ((k + 1)*(k + 2)), b, axes=1)))
+        dvel = dx*(a0 + np.tensordot(1 / (k + 1), b, axes=1))
+        pos, comp_pos = self._kahan(pos, dpos, comp_pos)
+        vel, comp_vel = self._kahan(vel, dvel, comp_vel)
+
+        xnext = x + dx
+        fnext = np.concatenate((pos, vel), axis=-1)
+        self.dx_next = np.sign(dx) * min(abs(dx_new), abs(dx) / self.safety)
+
+        # Warm start the next step by shifting the polynomial to its end
+        # and rescaling it to the next step size
+        q = self.dx_next / dx
+        b_next = np.zeros_like(b)
+        for i in range(7):
+            for j in range(i, 7):
+                b_next[i] += math.comb(j + 1, i + 1) * b[j]
+            b_next[i] *= q**(i + 1)
+        self._b_next = b_next
+        self._comp = (comp_pos, comp_vel)
+        self._keep_step(x, f, xnext, fnext, params)
+
+        return xnext, fnext
+
+    def dense(self,x):
+        """
+        See class Solver for full docstring.
+        """
+        if self._poly is None:
+            raise RuntimeError("dense() needs a step to interpolate")
+        pos, vel, a0, b, dx = self._poly
+        pos_s, vel_s = self._predict(pos, vel, a0, b, dx, (x - self._x_start) / dx)
+        return np.concatenate((pos_s, vel_s), axis=-1)
+
+class BulirschStoer(Solver):
+    """
+    Gragg-Bulirsch-Stoer extrapolation method with adaptive order and step.
+
+    A step of size H is computed several times with Gragg's modified 
+    midpoint rule using n = 2, 4, 6, ... substeps, and the results are 
+    extrapolated to zero substep size (Richardson extrapolation in h**2).
+    Row k of the extrapolation table is of order 2k, and the difference
+    between its last two entries estimates the error.  The step is accepted
+    as soon as that error is within tolerance.  The next step size and the
+    number of rows to aim for are picked to minimise the work per unit step.
+    Very efficient on smooth problems at tight tolerances.
+
+    ...
+
+    Attributes
+    ----------
+    diff_eq : method
+        Differential equation to solve.
+    rtol : float
+        Relative error tolerance per step.
+    atol : float
+        Absolute error tolerance per step.
+    k_max : int
+        Maximum number of rows of the extrapolation table.
+    dx_min : float
+        Smallest step the solver will try (accepted regardless of error).
+    dx_next : float or None
+        Suggested size of the next step, None until the first step is taken.
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    adaptive = True
+
+    sequence = [2, 4, 6, 8, 10, 12, 14, 16, 18, 20]
+
+    def __init__(self,diff_eq,rtol=1e-10,atol=1e-10,k_max=8,dx_min=1e-12):
+        super().__init__(diff_eq)
+        self.rtol = rtol
+        self.atol = atol
+        self.k_max = min(k_max, len(self.sequence))
+        self.dx_min = dx_min
+        self.dx_next = None
+        self._k_target = min(4, self.k_max - 1)
+
+        # Cost of building k rows of the table, in diff_eq evaluations
+        self._work = np.cumsum([1] + self.sequence[:self.k_max])
+
+    def _midpoint(self,x,f,df,H,n,params):
+        """Gragg's modified midpoint rule, n substeps over H."""
+        h = H / n
+        z_prev = f
+        z = f + (h*df)
+        for m in range(1, n):
+            z_prev, z = z, z_prev + (2*h*self.diff_eq(x + (m*h), z, params))
+        return 0.5*(z + z_prev + (h*self.diff_eq(x + H, z, params)))
+
+    def _step_factor(self,err,k):
+        """Step size factor for an error estimate from k rows."""
+        if err == 0:
+            return 4.0
+        factor = 0.94 * (0.65/err)**(1/(2*k - 1))
+        return min(4.0, max(0.05, factor))
+
+    def step(self,x,f,dx,params=None):
+        """
+        See class Solver for full docstring.
+
+        The step is first attempted with size dx and shrunk until the error 
+        estimate is within tolerance, so xnext may fall short of x + dx.
+        """
+        df = self.diff_eq(x, f, params)
+        H = dx
+
+        while True:
+            table = []
+            dx_opt = {}
+            work = {}
+            accepted = False
+            for k in range(1, min(self._k_target + 1, self.k_max) + 1):
+                n = self.sequence[k-1]
+                row = [self._midpoint(x, f, df, H, n, params)]
+                for j in range(1, k):
+                    ratio = (n / self.sequence[k-1-j])**2 - 1
+                    row.append(row[j-1] + ((row[j-1] - table[k-2][j-1]) / ratio))
+                table.append(row)
+
+                if k >= 2:
+                    scale = self.atol + (self.rtol * np.maximum(np.abs(f), np.abs(row[-1])))
+                    err = np.max(np.abs(row[-1] - row[-2]) / scale)
+                    if not np.isfinite(err):
+                        err = np.inf
+                    dx_opt[k] = H * self._step_factor(err, k)
+                    work[k] = self._work[k] / abs(dx_opt[k])
+                    if err <= 1:
+                        accepted = True
+                        break
+
+            if accepted or abs(H) <= self.dx_min:
+                break
+            # Rejected, retry with a smaller step
+            H = np.sign(H) * max(min(abs(dx_opt[k]), 0.5*abs(H)), self.dx_min)
+
+        # Pick the number of rows (the order) for the next step
+        k_next = k
+        dx_next = dx_opt[k]
+        if k >= 3 and work[k-1] < 0.8*work[k]:
+            k_next = k - 1
+            dx_next = dx_opt[k-1]
+        elif accepted and k == self._k_target + 1 and k < self.k_max - 1:
+            k_next = k + 1
+            dx_next = dx_opt[k] * self._work[k+1] / self._work[k]
+        elif accepted and k >= 3 and work[k] < 0.9*work[k-1] and k < self.k_max - 1:
+            k_next = k + 1
+            dx_next = dx_opt[k] * self._work[k+1] / self._work[k]
+        self._k_target = max(2, min(k_next, self.k_max - 1))
+        self.dx_next = dx_next
+
+        xnext = x + H
+        fnext = table[-1][-1]
+        self._keep_step(x, f, xnext, fnext, params, df=df)
+
+        return xnext, fnext
+
+class KustaanheimoStiefel(Solver):
+    """
+    Kustaanheimo-Stiefel regularization of close encounters.
+
+    Steps are taken with an ordinary solver, except when the step is too
+    long for the strongest pair of bodies, i.e. when dx*sqrt(mu/r**3) > eta
+    for their separation r and mu = G*(m_i + m_j).  The relative motion of
+    that pair is then written in KS variables u (4 components, r = |u|**2) 
+    in a fictitious time s with dt/ds = r,
+
+        u'' = (h/2)*u + (r/2)*L(u)^T P,    h' = 2*u'.L(u)^T P,    t' = r
+
+    where h is the Kepler energy of the pair (per unit reduced mass) and P
+    the relative acceleration due to the other bodies.  Unperturbed, this is
+    a harmonic oscillator, smooth however close the bodies come, so the 
+    encounter is integrated with the same solver in substeps of s instead
+    of shrinking dx.  The centre of mass of the pair and the other bodies
+    are advanced in s alongside (their derivatives times r).  The substeps
+    keep omega*ds below eta, omega = sqrt(|h|/2) being the frequency of the
+    oscillator, and the last one is adjusted to end on x + dx.
+
+    The Physics object supplies the gravitational parameters and the 
+    accelerations through pair_split(params).  The state must be laid out
+    as [pos | vel] in 3 dimensions, one row per body; states with a batch
+    axis are only stepped with the ordinary solver.  dense() interpolates 
+    between the substeps of a regularized step.
+
+    ...
+
+    Attributes
+    ----------
+    pair_split : method
+        See NBody.pair_split.
+    method : type
+        Fixed step solver class (callback 'diff_eq') for both the ordinary
+        steps and the substeps.
+    eta : float
+        Accuracy parameter of the switch and of the substeps.
+    pair : tuple of ints or None
+        Rows of the pair regularized during the last step, None if it was
+        an ordinary step.
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    callback = 'pair_split'
+
+    def __init__(self,pair_split,method=RK4,eta=0.02):
+        super().__init__(pair_split)
+        if method.adaptive or method.callback != 'diff_eq':
+            raise ValueError(f"{method.__name__} is not a fixed step solver of diff_eq")
+        self.pair_split = pair_split
+        self.method = method
+        self.eta = eta
+        self.pair = None
+        self._solver = method(self._diff_eq)
+        self._ks_solver = method(self._ks_diff_eq)
+        self._substeps = None
+
+    def _diff_eq(self,x,f,params):
+        """Derivative of the state in time."""
+        gm, accel = self.pair_split(params)
+        return self._with_velocity(f, accel(x, f[...,:3]))
+
+    def _derivative(self,x,f,params=None):
+        """Derivative of the state, for dense()."""
+        return self._diff_eq(x, f, params)
+
+    @staticmethod
+    def _L(u):
+        """KS matrix L(u)."""
+        u1, u2, u3, u4 = u
+        return np.array([[u1, -u2, -u3, u4],
+                         [u2, u1, -u4, -u3],
+                         [u3, u4, u1, u2],
+                         [u4, -u3, u2, -u1]])
+
+    @classmethod
+    def to_ks(cls,r,v):
+        """KS position u and velocity u' = du/ds of a relative position and velocity."""
+        x1, x2, x3 = r
+        d = np.sqrt(np.sum(r**2))
+        if x1 >= 0:
+            u1 = np.sqrt(0.5*(d + x1))
+            u = np.array([u1, 0.5*x2/u1, 0.5*x3/u1, 0.0])
+        else:
+            u2 = np.sqrt(0.5*(d - x1))
+            u = np.array([0.5*x2/u2, u2, 0.0, 0.5*x3/u2])
+        w = 0.5 * (cls._L(u).T @ np.append(v, 0.0))
+        return u, w
+
+    @classmethod
+    def from_ks(cls,u,w):
+        """Relative position and velocity of a KS position and velocity."""
+        L = cls._L(u)
+        r = (L @ u)[:3]
+        v = (2/np.dot(u, u)) * (L @ w)[:3]
+        return r, v
+
+    def _strongest_pair(self,f,gm):
+        """Rows, mu and separation of the pair with the strongest mutual attraction."""
+        i, j = np.triu_indices(len(gm), 1)
+        r = np.sqrt(np.sum((f[j,:3] - f[i,:3])**2, axis=-1))
+        mu = gm[i] + gm[j]
+        k = int(np.argmax(mu / r**2))
+        return int(i[k]), int(j[k]), mu[k], r[k]
+
+    def _ks_diff_eq(self,s,y,context):
+        """Derivative in s of the regularized state y (see _pack)."""
+        params, i, j, gm, mu = context
+        u, w, h, t = y[0:4], y[4:8], y[8], y[9]
+        g = y[10:].reshape(-1, 6)
+        L = self._L(u)
+        r = np.dot(u, u)
+        x_rel = (L @ u)[:3]
+
+        # Positions of all the bodies, the pair from its centre of mass
+        pos = g[:,:3].copy()
+        pos[i] = g[i,:3] - ((gm[j]/mu) * x_rel)
+        pos[j] = g[i,:3] + ((gm[i]/mu) * x_rel)
+        a = self.pair_split(params)[1](t, pos)
+
+        # Remove the pair's own attraction
+        pull = x_rel / r**3
+        a_i = a[i] - (gm[j]*pull)
+        a_j = a[j] + (gm[i]*pull)
+        LTP = L.T @ np.append(a_j - a_i, 0.0)
+
+        dg = np.empty(g.shape)
+        dg[:,:3] = g[:,3:]
+        dg[:,3:] = a
+        dg[i,3:] = ((gm[i]*a_i) + (gm[j]*a_j)) / mu
+        dg[j] = 0
+
+        dy = np.empty(y.shape)
+        dy[0:4] = w
+        dy[4:8] = (0.5*h*u) + ((0.5*r)*LTP)
+        dy[8] = 2*np.dot(w, LTP)
+        dy[9] = r
+        dy[10:] = r * dg.ravel()
+        return dy
+
+    @classmethod
+    def _pack(cls,x,f,i,j,gm,mu):
+        """Regularized state [u, u', h, t, state with row i the pair's centre of mass]."""
+        u, w = cls.to_ks(f[j,:3] - f[i,:3], f[j,3:] - f[i,3:])
+        r = np.dot(u, u)
+        v_rel = f[j,3:] - f[i,3:]
+        h = (0.5*np.dot(v_rel, v_rel)) - (mu/r)
+        g = np.array(f, dtype=float)
+        g[i] = ((gm[i]*f[i]) + (gm[j]*f[j])) / mu
+        g[j] = 0
+        return np.concatenate((u, w, [h, x], g.ravel()))
+
+    @classmethod
+    def _unpack(cls,y,i,j,gm,mu):
+        """Time and state of a regularized state."""
+        x_rel, v_rel = cls.from_ks(y[0:4], y[4:8])
+        g = y[10:].reshape(-1, 6)
+        f = g.copy()
+        f[i] = g[i] - ((gm[j]/mu) * np.concatenate((x_rel, v_rel)))
+        f[j] = g[i] + ((gm[i]/mu) * np.concatenate((x_rel, v_rel)))
+        return y[9], f
+
+    def step(self,x,f,dx,params=None):
+        """
+        See class Solver for full docstring.
+        """
+        gm = np.asarray(self.pair_split(params)[0], dtype=float)
+        self.pair = None
+        self._substeps = None
+        if np.ndim(f) == 2 and len(gm) >= 2:
+            i, j, mu, r = self._strongest_pair(f, gm)
+            if mu > 0 and abs(dx)*np.sqrt(mu / r**3) > self.eta:
+                self.pair = (i, j)
+
+        if self.pair is None:
+            xnext, fnext = self._solver.step(x, f, dx, params)
+            df = self._solver._df
+            self._keep_step(x, f, xnext, fnext, params, df=df[0], dfnext=df[1])
+            return xnext, fnext
+
+        context = (params, i, j, gm, mu)
+        y = self._pack(x, f, i, j, gm, mu)
+        x_end = x + dx
+        times = [x]
+        states = [np.array(f, dtype=float)]
+        while x_end - y[9] > 1e-14 * max(1, abs(x_end)):
+            r = np.dot(y[0:4], y[0:4])
+            ds = (x_end - y[9]) / r
+            omega = np.sqrt(0.5*abs(y[8]))
+            last = omega*ds <= self.eta
+            if not last:
+                ds = self.eta / omega
+            # The equations do not depend on s itself
+            y_next = self._ks_solver.step(0.0, y, ds, context)[1]
+            if last or y_next[9] > x_end:
+                # Adjust the substep to end on x_end
+                def substep(ds):
+                    y_next = self._ks_solver.step(0.0, y, ds, context)[1]
+                    return y_next[9] - y[9], y_next
+                y_next = _land(substep, ds, y_next[9] - y[9], y_next, x_end - y[9])
+                y_next[9] = x_end
+            y = y_next
+            t, f_k = self._unpack(y, i, j, gm, mu)
+            times.append(t)
+            states.append(f_k)
+
+        xnext, fnext = self._unpack(y, i, j, gm, mu)
+        self._substeps = (np.array(times), states, {})
+        self._keep_step(x, f, xnext, fnext, params)
+        return xnext, fnext
+
+    def dense(self,x):
+        """
+        See class Solver for full docstring.
+
+        After a regularized step, the cubic Hermite interpolant is fitted 
+        to the substep containing x, whose end derivatives are evaluated
+        (once) when first needed.
+        """
+        if self._substeps is None:
+            return super().dense(x)
+        times, states, slopes = self._substeps
+        k = int(np.clip(np.searchsorted(times, x) - 1, 0, len(times) - 2))
+        for m in (k, k + 1):
+            if m not in slopes:
+                slopes[m] = self._derivative(times[m], states[m], self._params_last)
+        return self._hermite(x, times[k], times[k+1], states[k], states[k+1], slopes[k], slopes[k+1])
+
+class WisdomHolman(Solver):
+    """
+    Wisdom-Holman symplectic map for systems dominated by one central mass.
+
+    The motion is split into Kepler orbits about the central body, which are
+    advanced exactly (universal variable Kepler solver), and the much weaker
+    interactions between the other bodies, applied as kicks.  The step then
+    only has to resolve the interactions rather than the orbits themselves,
+    so it can be a sizeable fraction of the shortest orbital period.  With a
+    central body in the state, democratic heliocentric coordinates are used:
+    heliocentric positions, barycentric velocities, and a linear drift of
+    the positions by the central body's momentum.
+
+        kick dx/2, drift dx/2, Kepler dx, drift dx/2, kick dx/2
+
+    The Physics object supplies the split through kepler_split(params),
+    which returns the row of the central body (None for an attractor fixed
+    at the origin), its gravitational parameter and the interaction
+    accelerations.  The state must be laid out as [pos | vel] along its 
+    last axis.  dense() maps the start of the last step forward by the
+    required fraction of it, which keeps the Kepler motion exact.
+
+    ...
+
+    Attributes
+    ----------
+    kepler_split : method
+        See NBody.kepler_split.
+    tolerance : float
+        Convergence tolerance of the Kepler solver.
+
+    Methods
+    -------
+    step():
+        see Solver class for full docstring.
+    """
+    callback = 'kepler_split'
+
+    max_iterations = 50
+
+    def __init__(self,kepler_split,tolerance=1e-14):
+        super().__init__(kepler_split)
+        self.kepler_split = kepler_split
+        self.tolerance = tolerance
+
+    @staticmethod
+    def _stumpff(z):
+        """Stumpff functions c2(z) and c3(z)."""
+        z = np.asarray(z, dtype=float)
+        c2 = np.empty_like(z)
+        c3 = np.empty_like(z)
+        small = np.abs(z) < 0.1
+        pos = (z > 0) & ~small
+        neg = (z < 0) & ~small
+
+        zs = z[small]
+        c2[small] = 1/2 - zs/24 + zs**2/720 - zs**3/40320 + zs**4/3628800 - zs**5/479001600
+        c3[small] = 1/6 - zs/120 + zs**2/5040 - zs**3/362880 + zs**4/39916800 - zs**5/6227020800
+        sz = np.sqrt(z[pos])
+        c2[pos] = (1 - np.cos(sz)) / z[pos]
+        c3[pos] = (sz - np.sin(sz)) / sz**3
+        sz = np.sqrt(-z[neg])
+        c2[neg] = (np.cosh(sz) - 1) / -z[neg]
+        c3[neg] = (np.sinh(sz) - sz) / sz**3
+        return c2, c3
+
+    def kepler_drift(self,pos,vel,mu,dt):
+        """
+        Advance Kepler orbits about a mass at the origin.
+
+        Parameters
+        ----------
+        pos, vel : ndarray of floats
+            Positions and velocities, one orbit per row.
+        mu : float
+            Gravitational parameter of the central mass.
+        dt : float
+            Time step.
+
+        Returns
+        -------
+        pos, vel : ndarray of floats
+            Positions and velocities after dt.
+        """
+        r0 = np.sqrt(np.sum(pos**2, axis=-1))
+        v0_sq = np.sum(vel**2, axis=-1)
+        sqrt_mu = np.sqrt(mu)
+        sigma0 = np.sum(pos*vel, axis=-1) / sqrt_mu
+        alpha = (2/r0) - (v0_sq/mu)         # 1/a
+
+        # Solve the universal Kepler equation for chi (Laguerre-Conway)
+        chi = sqrt_mu * dt / r0
+        for i in range(self.max_iterations):
+            z = alpha * chi**2
+            c2, c3 = self._stumpff(z)
+            F = (r0*chi) + (sigma0*chi**2*c2) + ((1 - alpha*r0)*chi**3*c3) - (sqrt_mu*dt)
+            dF = (chi**2*c2) + (sigma0*chi*(1 - z*c3)) + (r0*(1 - z*c2))
+            ddF = (sigma0*(1 - z*c2)) + ((1 - alpha*r0)*chi*(1 - z*c3))
+            root = np.sqrt(np.abs(16*dF**2 - 20*F*ddF))
+            delta = 5*F / (dF + (np.sign(dF)*root))
+            chi = chi - delta
+            if np.all(np.abs(delta) <= self.tolerance*np.maximum(np.abs(chi), 1e-300)):
+                break
+
+        z = alpha * chi**2
+        c2, c3 = self._stumpff(z)
+        r = (chi**2*c2) + (sigma0*chi*(1 - z*c3)) + (r0*(1 - z*c2))
+        f = 1 - (chi**2/r0)*c2
+        g = dt - (chi**3/sqrt_mu)*c3
+        fdot = (sqrt_mu/(r*r0)) * chi * (z*c3 - 1)
+        gdot = 1 - (chi**2/r)*c2
+
+        pos_next = (f[...,None]*pos) + (g[...,None]*vel)
+        vel_next = (fdot[...,None]*pos) + (gdot[...,None]*vel)
+        return pos_next, vel_next
+
+    def step(self,x,f,dx,params=None):
+        """
+        See class Solver for full docstring.
+        """
+        xnext = x + dx
+        fnext = self._map(x, f, dx, params)
+        self._keep_step(x, f, xnext, fnext, params)
+
+        return xnext, fnext
+
+    def dense(self,x):
+        """
+        See class Solver for full docstring.
+        """
+        if self._f_start is None:
+            raise RuntimeError("dense() needs a step to interpolate")
+        return self._map(self._x_start, self._f_start, x - self._x_start, self._params_last)
+
+    def _map(self,x,f,dx,params):
+        """The state after one step of the map from x to x + dx."""
+        central, mu, interaction = self.kepler_split(params)
+        n = np.shape(f)[-1] // 2
+        pos = np.array(f[...,:n], dtype=float)
+        vel = np.array(f[...,n:], dtype=float)
+        xnext = x + dx
+
+        if central is None:
+            vel += (dx/2)*interaction(x, pos)
+            pos, vel = self.kepler_drift(pos, vel, mu, dx)
+            vel += (dx/2)*interaction(xnext, pos)
+            return np.concatenate((pos, vel), axis=-1)
+
+        # Democratic heliocentric coordinates
+        m = params.m
+        M = np.sum(m)
+        m_c = m[central]
+        m_o = np.delete(m, central)[:,None]
+        r_cm = np.sum(m[:,None]*pos, axis=0) / M
+        v_cm = np.sum(m[:,None]*vel, axis=0) / M
+        Q = np.delete(pos, central, axis=0) - pos[central]
+        V = np.delete(vel, central, axis=0) - v_cm
+
+        V += (dx/2)*interaction(x, Q)                       # kick
+        Q += (dx/2)*np.sum(m_o*V, axis=0)/m_c               # drift
+        Q, V = self.kepler_drift(Q, V, mu, dx)              # Kepler
+        Q += (dx/2)*np.sum(m_o*V, axis=0)/m_c               # drift
+        V += (dx/2)*interaction(xnext, Q)                   # kick
+
+        # Back to the original frame
+        r_cm = r_cm + (dx*v_cm)
+        pos_c = r_cm - (np.sum(m_o*Q, axis=0)/M)
+        vel_c = v_cm - (np.sum(m_o*V, axis=0)/m_c)
+        pos = np.insert(Q + pos_c, central, pos_c, axis=0)
+        vel = np.insert(V + v_cm, central, vel_c, axis=0)
 
-        return xnext, fnext
\ No newline at end of file
+        return np.concatenate((pos, vel), axis=-1)